@@ -0,0 +1,241 @@
+"""Benchmarks curator actions against the stand-in docker of ``fake_docker.py``.
+
+Each scenario prepares a simulated host (with ``--images`` unrelated images and ``--containers`` unrelated
+containers) and a library, and each action is then run ``--repeat`` times with ``curator.py --direct`` from the same
+prepared state. For every scenario and action, the docker calls made (by command), the bytes of their outputs parsed
+by curator, the end-to-end wall time and the return code are reported as JSON. With ``--baseline``, actions making
+more docker calls than in an earlier report (or failing only now) are listed as regressions and the exit status is 1.
+
+With ``--backend api``, curator talks to the same simulated host through the stand-in engine API of
+``fake_engine_api.py`` instead, and ``fake_docker.py`` is only run as the ``docker`` executable of ``attach``.
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_docker
+import fake_engine_api
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CURATOR = os.path.join(BENCHMARK_DIRECTORY, os.pardir, "curator.py")
+PYTOOLS = os.path.join(BENCHMARK_DIRECTORY, os.pardir, "third_party", "pytools")
+
+SCENARIOS = {
+    # Nothing of the library exists on the host
+    "cold_host": {"setup": [], "stop": False, "mounts": 1, "devices": 0},
+    # The library is built and its container is running
+    "existing_container": {"setup": ["build", "start"], "stop": False, "mounts": 1, "devices": 0},
+    # The library is built and its container is stopped
+    "stopped_container": {"setup": ["build", "start"], "stop": True, "mounts": 1, "devices": 0},
+    # The library is built and mounts many sources (each found at its second trial) and devices
+    "many_mounts": {"setup": ["build"], "stop": False, "mounts": 64, "devices": 16},
+}
+ACTIONS = ("build", "start", "attach", "clean")
+
+
+def write_json(path, data):
+    with open(path, "w") as writer:
+        json.dump(data, writer, indent=2)
+
+
+def make_workspace(path, scenario, images, containers, backend):
+    fake_docker.make_host(os.path.join(path, "host"), images=images, containers=containers)
+    work = os.path.join(path, "work")
+    os.makedirs(os.path.join(work, "library"))
+    if backend == "api":
+        dockers = {"fake": {"backend": "api", "socket": os.path.join(path, "docker.sock"), "has_gpus_support": True}}
+        os.makedirs(os.path.join(path, "bin"))
+        os.symlink(os.path.join(BENCHMARK_DIRECTORY, "fake_docker.py"), os.path.join(path, "bin", "docker"))
+    else:
+        dockers = {os.path.join(BENCHMARK_DIRECTORY, "fake_docker.py"): {"has_gpus_support": True}}
+    write_json(os.path.join(work, "defaults.json"), {"dockers": dockers})
+    with open(os.path.join(work, "library", "Dockerfile"), "w") as writer:
+        writer.write("FROM fake/image0\nARG UID\nRUN useradd -u $UID user\nUSER user\n")
+
+    mounts = dict()
+    for index in range(SCENARIOS[scenario]["mounts"]):
+        source = os.path.join(work, "mounts", f"source{index}")
+        os.makedirs(source)
+        mounts[f"mount{index}"] = [
+            [{"source": os.path.join(work, "missing", f"source{index}"), "target": f"/mnt/{index}", "mode": "ro"}],
+            [{"source": source, "target": f"/mnt/{index}", "mode": "ro"}]
+        ]
+    os.makedirs(os.path.join(work, "dev"))
+    for index in range(SCENARIOS[scenario]["devices"]):
+        open(os.path.join(work, "dev", f"fake{index}"), "w").close()
+
+    write_json(os.path.join(work, "library", "config.json"), {
+        "library": {"name": "benchmark/library", "arguments": {"UID": "$%EUID"}},
+        "runtime": {
+            "name": "benchmark_library",
+            "mounts": mounts,
+            "devices": [os.path.join(work, "dev", "fake*")] if SCENARIOS[scenario]["devices"] else [],
+            "networks": {"10000": "10000"},
+            "environment": {"BENCHMARK": "1"},
+            "attributes": {"use_gpus": True},
+            "extra_args": ["--shm-size=16G"]
+        }
+    })
+
+
+def start_engine_api(path):
+    """Starts the stand-in engine API serving the simulated host of a workspace, and waits for its socket."""
+    server = subprocess.Popen([sys.executable, fake_engine_api.__file__, os.path.join(path, "docker.sock")],
+                              env=dict(os.environ, FAKE_DOCKER_HOME=os.path.join(path, "host")))
+    while not os.path.exists(os.path.join(path, "docker.sock")):
+        if server.poll() is not None:
+            raise RuntimeError(f"The stand-in engine API has exited with return code {server.returncode}")
+        time.sleep(0.01)
+    return server
+
+
+def run_curator(path, action):
+    # The docker executable of the api backend (if any) is found on the path
+    environ = dict(os.environ, FAKE_DOCKER_HOME=os.path.join(path, "host"), XDG_CACHE_HOME=os.path.join(path, "cache"),
+                   PYTHONPATH=os.pathsep.join(filter(None, [PYTOOLS, os.environ.get("PYTHONPATH")])),
+                   PATH=os.pathsep.join([os.path.join(path, "bin"), os.environ.get("PATH", os.defpath)]))
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, CURATOR, "--direct", action, "library"], cwd=os.path.join(path, "work"),
+                            env=environ, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return time.perf_counter() - start_time, result
+
+
+def load_calls(path):
+    with open(os.path.join(path, "host", "calls.jsonl"), "r") as reader:
+        return [json.loads(line) for line in reader if line.strip()]
+
+
+def prepare_scenario(path, scenario, images, containers, latency, backend):
+    make_workspace(path, scenario, images, containers, backend)
+    for action in SCENARIOS[scenario]["setup"]:
+        _, result = run_curator(path, action)
+        if result.returncode != 0:
+            raise RuntimeError(f"Cannot prepare scenario {scenario} with {action}:\n{result.stdout.decode('utf-8')}")
+    if SCENARIOS[scenario]["stop"]:
+        with open(os.path.join(path, "host", "state.json"), "r") as reader:
+            state = json.load(reader)
+        state["containers"]["benchmark_library"]["status"] = "Exited (0) 5 minutes ago"
+        write_json(os.path.join(path, "host", "state.json"), state)
+    write_json(os.path.join(path, "host", "host.json"), {"latency": latency})
+    open(os.path.join(path, "host", "calls.jsonl"), "w").close()
+    for name in ("host", "cache"):
+        if os.path.isdir(os.path.join(path, name)):
+            shutil.copytree(os.path.join(path, name), os.path.join(path, "prepared", name))
+
+
+def restore_scenario(path):
+    for name in ("host", "cache"):
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        if os.path.isdir(os.path.join(path, "prepared", name)):
+            shutil.copytree(os.path.join(path, "prepared", name), os.path.join(path, name))
+
+
+def benchmark(scenario, action, path, repeat, backend):
+    wall_times, calls, result = [], [], None
+    for _ in range(repeat):
+        restore_scenario(path)
+        wall_time, result = run_curator(path, action)
+        wall_times.append(wall_time)
+        calls = load_calls(path)
+
+    commands = collections.Counter(call["args"][0] if call["args"][0] != "image" else ' '.join(call["args"][:2])
+                                   for call in calls)
+    return {
+        "backend": backend,
+        "scenario": scenario,
+        "action": action,
+        "return_code": result.returncode,
+        # The end of the output tells why a failing action has failed
+        "output_tail": result.stdout.decode('utf-8', errors='replace').splitlines()[-5:] if result.returncode else [],
+        "docker_calls": len(calls),
+        "docker_calls_by_command": dict(sorted(commands.items())),
+        "docker_bytes_parsed": sum(call["stdout_bytes"] + call["stderr_bytes"] for call in calls),
+        "docker_time": sum(call["time"] for call in calls),
+        "wall_time": {"min": min(wall_times), "median": statistics.median(wall_times), "max": max(wall_times)},
+    }
+
+
+def get_regressions(results, baseline):
+    # Reports written before the api backend was benchmarked only have cli results
+    previous = {(result.get("backend", "cli"), result["scenario"], result["action"]): result
+                for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["backend"], result["scenario"], result["action"])
+        if key in previous and result["return_code"] != 0 and previous[key]["return_code"] == 0:
+            regressions.append(f"{'/'.join(key)}: failed with return code {result['return_code']}")
+        elif key in previous and previous[key]["return_code"] == 0 and \
+                result["docker_calls"] > previous[key]["docker_calls"]:
+            regressions.append(f"{'/'.join(key)}: {previous[key]['docker_calls']} -> {result['docker_calls']} "
+                               f"docker calls")
+    return regressions
+
+
+def main(args):
+    results = []
+    for scenario in args.scenario:
+        path = tempfile.mkdtemp(prefix=f"curator-benchmark-{scenario}-")
+        server = start_engine_api(path) if args.backend == "api" else None
+        try:
+            prepare_scenario(path, scenario, args.images, args.containers, args.latency, args.backend)
+            for action in args.action:
+                result = benchmark(scenario, action, path, args.repeat, args.backend)
+                results.append(result)
+                print(f"{scenario:>20} {action:>8}: {result['docker_calls']:3d} docker calls, "
+                      f"{result['docker_bytes_parsed']:8d} bytes parsed, {result['wall_time']['median']:.3f}s"
+                      f"{'' if result['return_code'] == 0 else ' (failed)'}", file=sys.stderr)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if not args.keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "time": time.time(),
+                        "backend": args.backend, "images": args.images, "containers": args.containers,
+                        "latency": args.latency, "repeat": args.repeat},
+        "results": results
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        write_json(args.output, report)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as reader:
+            regressions = get_regressions(results, json.load(reader))
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark curator actions against a stand-in docker")
+    parser.add_argument("-o", "--output", type=str, default=None, help="write the report to a file (default: stdout)")
+    parser.add_argument("--scenario", type=str, nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS),
+                        help="scenarios to be benchmarked")
+    parser.add_argument("--action", type=str, nargs="+", default=list(ACTIONS), choices=ACTIONS,
+                        help="actions to be benchmarked")
+    parser.add_argument("--backend", type=str, default="cli", choices=("cli", "api"),
+                        help="docker backend of curator, which talks to fake_docker.py or to fake_engine_api.py")
+    parser.add_argument("--images", type=int, default=200, help="number of unrelated images on the simulated host")
+    parser.add_argument("--containers", type=int, default=50,
+                        help="number of unrelated containers on the simulated host")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds taken by every docker call")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of every action")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="earlier report to be compared with (fails if any action makes more docker calls)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary workspaces")
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""Stand-in docker executable for benchmarking curator without a docker daemon.
+
+It keeps the images and containers of a simulated host in ``$FAKE_DOCKER_HOME/state.json``, sleeps for the latency of
+``$FAKE_DOCKER_HOME/host.json`` before answering each call, and appends every invocation (arguments, wall time, output
+bytes and return code) to ``$FAKE_DOCKER_HOME/calls.jsonl``. Only the commands and output formats used by curator are
+understood.
+
+Layers have pseudo-random contents generated from a seed (or kept under ``$FAKE_DOCKER_HOME/layers`` once loaded), and
+their digests are the ones of their contents, so ``save`` and ``load`` exchange archives in the format of docker.
+"""
+
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tarfile
+import time
+
+HOME = os.environ.get("FAKE_DOCKER_HOME", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_host"))
+VERSION = "24.0.7"
+# Layers shared by all the images of a simulated host, and the size of every other layer
+BASE_LAYERS = (("fake-base-0", 4 << 20), ("fake-base-1", 1 << 20))
+LAYER_SIZE = 64 << 10
+
+
+def make_host(path, images=0, containers=0, latency=0.0):
+    """Writes a simulated host with ``images`` images and ``containers`` containers (one out of four is stopped)."""
+    os.makedirs(path, exist_ok=True)
+    state = {"images": {}, "containers": {}, "layers": {}}
+    base_layers = [add_layer(state, seed, size) for seed, size in BASE_LAYERS]
+    for index in range(images):
+        add_image(state, f"fake/image{index}:latest", labels={}, base_layers=base_layers)
+    for index in range(containers):
+        state["containers"][f"fake_container{index}"] = {
+            "image": f"fake/image{index % images}" if images else "busybox",
+            "status": "Exited (0) 2 hours ago" if index % 4 == 3 else "Up 2 hours",
+            "labels": {}
+        }
+    with open(os.path.join(path, "host.json"), "w") as writer:
+        json.dump({"latency": latency}, writer)
+    with open(os.path.join(path, "state.json"), "w") as writer:
+        json.dump(state, writer)
+    open(os.path.join(path, "calls.jsonl"), "w").close()
+
+
+def get_layer_content(layer):
+    if "seed" not in layer:
+        with open(os.path.join(HOME, "layers", layer["file"]), "rb") as reader:
+            return reader.read()
+    # Half random and half repeated, so the layers compress like real ones do
+    generator = random.Random(layer["seed"])
+    return generator.randbytes(layer["size"] // 2) + bytes(layer["size"] - layer["size"] // 2)
+
+
+def add_layer(state, seed, size=LAYER_SIZE):
+    layer = {"seed": seed, "size": size}
+    digest = f"sha256:{hashlib.sha256(get_layer_content(layer)).hexdigest()}"
+    state["layers"][digest] = layer
+    return digest
+
+
+def get_image_config(image):
+    config = {"architecture": "amd64", "os": "linux", "config": {"Env": image["env"], "Labels": image["labels"]},
+              "rootfs": {"type": "layers", "diff_ids": image["layers"]}}
+    return json.dumps(config, sort_keys=True).encode('utf-8')
+
+
+def add_image(state, reference, labels, content='', base_layers=(), env=None, layers=None):
+    if layers is None:
+        seed = json.dumps([reference, labels, content], sort_keys=True)
+        layers = list(base_layers) + [add_layer(state, seed)]
+    image = {
+        "env": env or ["PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin", "HOME=/root"],
+        "labels": labels,
+        "size": sum(state["layers"][layer]["size"] for layer in layers),
+        "layers": layers
+    }
+    image["id"] = f"sha256:{hashlib.sha256(get_image_config(image)).hexdigest()}"
+    state["images"][reference] = image
+
+
+def get_reference(name):
+    if ':' not in name.rsplit('/', 1)[-1] and '@' not in name:
+        return f"{name}:latest"
+    return name
+
+
+def get_options(args, *names):
+    values = []
+    for index, arg in enumerate(args):
+        for name in names:
+            if arg == name and index + 1 < len(args):
+                values.append(args[index + 1])
+            elif arg.startswith(f"{name}="):
+                values.append(arg.split('=', 1)[1])
+    return values
+
+
+def get_positionals(args, valued_options):
+    positionals, index = [], 0
+    while index < len(args):
+        if args[index] in valued_options:
+            index += 2
+            continue
+        if not args[index].startswith('-'):
+            positionals.append(args[index])
+        index += 1
+    return positionals
+
+
+def get_image_record(reference, image):
+    """Returns the record of an image, as written by ``docker image inspect`` and the engine API."""
+    return {"Id": image["id"], "RepoTags": [reference], "Size": image["size"],
+            "Config": {"Env": image["env"], "Labels": image["labels"]},
+            "RootFS": {"Type": "layers", "Layers": image["layers"]}}
+
+
+def pull(state, name):
+    """Pulls an image from the simulated registry, which has every image, and returns the output lines of docker."""
+    reference = get_reference(name)
+    add_image(state, reference, labels={}, base_layers=[add_layer(state, seed, size) for seed, size in BASE_LAYERS])
+    return [f"{reference.rsplit(':', 1)[-1]}: Pulling from {reference.rsplit(':', 1)[0]}",
+            f"Digest: {state['images'][reference]['id']}", f"Status: Downloaded newer image for {reference}"]
+
+
+def build(state, tag, labels, instructions, use_no_cache=False):
+    """Builds an image on top of its ``FROM`` base (which is pulled if it is missing), and returns the output lines of
+    docker."""
+    lines = ["Sending build context to Docker daemon  2.048kB"]
+    for index, instruction in enumerate(instructions):
+        lines.append(f"Step {index + 1}/{len(instructions)} : {instruction}")
+        lines.append(" ---> Using cache" if not use_no_cache and index == 0 else " ---> Running in 0123")
+        lines.append(f" ---> {hashlib.sha256(instruction.encode('utf-8')).hexdigest()[:12]}")
+    bases = [instruction.split()[1] for instruction in instructions if instruction.upper().startswith("FROM ")]
+    if bases and get_reference(bases[-1]) not in state["images"]:
+        lines[1:1] = pull(state, bases[-1])
+    base = state["images"].get(get_reference(bases[-1])) if bases else None
+    previous = state["images"].get(get_reference(tag))
+    add_image(state, get_reference(tag), labels, content='\n'.join(instructions),
+              base_layers=base["layers"] if base is not None else ())
+    if previous is not None and previous["id"] != state["images"][get_reference(tag)]["id"]:
+        # Like docker, containers of the image that lost its tag show the image by its ID
+        for container in state["containers"].values():
+            if get_reference(container["image"]) == get_reference(tag):
+                container["image"] = previous["id"][7:19]
+    lines.append(f"Successfully built {state['images'][get_reference(tag)]['id'][7:19]}")
+    lines.append(f"Successfully tagged {get_reference(tag)}")
+    return lines
+
+
+def create_container(state, name, image, labels, spec=None):
+    """Creates a running container, and returns the error of docker if it cannot be created."""
+    if name in state["containers"]:
+        return f"Conflict. The container name \"/{name}\" is already in use."
+    if get_reference(image) not in state["images"]:
+        return f"No such image: {image}"
+    state["containers"][name] = {"image": image, "status": "Up Less than a second", "labels": labels}
+    if spec is not None:
+        state["containers"][name]["spec"] = spec
+    return None
+
+
+def remove_image(state, name):
+    """Removes an image unless a container uses it, and returns the error of docker if it cannot be removed."""
+    users = [container for container, options in state["containers"].items()
+             if get_reference(options["image"]) == get_reference(name)]
+    if users:
+        return f"conflict: unable to remove repository reference \"{name}\" (must force) - container {users[0]} is " \
+               f"using its referenced image"
+    if state["images"].pop(get_reference(name), None) is None:
+        return f"No such image: {name}"
+    return None
+
+
+def format_record(template, record):
+    if re.fullmatch(r"\{\{\s*json\s+\.\s*\}\}", template):
+        return json.dumps(record)
+    template = re.sub(r"\{\{\s*\.Label\s+\"([^\"]+)\"\s*\}\}",
+                      lambda matched: record.get("Labels", {}).get(matched.group(1), ''), template)
+    return re.sub(r"\{\{\s*\.(\w+)\s*\}\}", lambda matched: str(record.get(matched.group(1), '')), template)
+
+
+def execute(args, state):
+    """Runs a docker command on the state, and returns its stdout, stderr and return code."""
+    command, args = args[0], args[1:]
+    if command == "--version":
+        return f"Docker version {VERSION}, build afdd53b\n", '', 0
+
+    if command == "images":
+        patterns = [value[len("reference="):] for value in get_options(args, "--filter", "-f")
+                    if value.startswith("reference=")]
+        lines = []
+        for reference, image in state["images"].items():
+            if patterns and not any(fnmatch.fnmatchcase(reference, get_reference(pattern)) for pattern in patterns):
+                continue
+            repository, tag = reference.rsplit(':', 1)
+            record = {"Repository": repository, "Tag": tag, "Size": f"{image['size'] / 1e6:.3g}MB",
+                      "ID": image["id"] if "--no-trunc" in args else image["id"][7:19], "Labels": image["labels"]}
+            lines.append(format_record(get_options(args, "--format")[0], record))
+        return ''.join(f"{line}\n" for line in lines), '', 0
+
+    if command == "ps":
+        filters = get_options(args, "--filter", "-f")
+        patterns = [value[len("name="):] for value in filters if value.startswith("name=")]
+        labels = [value[len("label="):] for value in filters if value.startswith("label=")]
+        lines = []
+        for name, container in state["containers"].items():
+            if patterns and not any(re.search(pattern, f"/{name}") for pattern in patterns):
+                continue
+            if any(label not in container["labels"] for label in labels):
+                continue
+            if "-a" not in args and not container["status"].startswith("Up"):
+                continue
+            size = container.get("size", 0)
+            virtual_size = size + state["images"].get(get_reference(container["image"]), {"size": 0})["size"]
+            record = {"Names": name, "Image": container["image"], "Status": container["status"], "ID": name[:12],
+                      "Labels": container["labels"], "Size": f"{size}B (virtual {virtual_size / 1e6:.3g}MB)"}
+            lines.append(format_record(get_options(args, "--format")[0], record))
+        return ''.join(f"{line}\n" for line in lines), '', 0
+
+    if command in ("inspect", "image") and (command == "inspect" or args[:1] == ["inspect"]):
+        names = get_positionals(args[1:] if command == "image" else args, {"--format", "-f"})
+        records = []
+        for name in names:
+            image = state["images"].get(get_reference(name))
+            if image is None:
+                return "[]\n", f"Error: No such image: {name}\n", 1
+            records.append(get_image_record(get_reference(name), image))
+        return json.dumps(records, indent=4) + "\n", '', 0
+
+    if command == "system" and args[:1] == ["df"]:
+        layers = {layer for image in state["images"].values() for layer in image["layers"]}
+        records = [{"Type": "Images", "TotalCount": len(state["images"]),
+                    "Size": f"{sum(state['layers'][layer]['size'] for layer in layers) / 1e6:.3g}MB"},
+                   {"Type": "Containers", "TotalCount": len(state["containers"]),
+                    "Size": f"{sum(container.get('size', 0) for container in state['containers'].values())}B"}]
+        lines = [format_record(get_options(args, "--format")[0], record) for record in records]
+        return ''.join(f"{line}\n" for line in lines), '', 0
+
+    if command == "build":
+        positionals = get_positionals(args, {"-t", "--tag", "--build-arg", "--label", "-f", "--file"})
+        tag = get_options(args, "-t", "--tag")[0]
+        labels = dict(label.split('=', 1) for label in get_options(args, "--label"))
+        with open(os.path.join(positionals[-1], "Dockerfile"), "r") as reader:
+            instructions = [line.strip() for line in reader if line.strip() and not line.startswith('#')]
+        lines = build(state, tag, labels, instructions, use_no_cache="--no-cache" in args)
+        return ''.join(f"{line}\n" for line in lines), '', 0
+
+    if command == "pull":
+        return ''.join(f"{line}\n" for line in pull(state, args[-1])), '', 0
+
+    if command == "run":
+        name, image = get_options(args, "--name")[0], args[-1]
+        labels = dict(label.split('=', 1) for label in get_options(args, "--label", "-l"))
+        error = create_container(state, name, image, labels)
+        if error is not None:
+            return '', f"docker: Error response from daemon: {error}\n", 125
+        return f"{hashlib.sha256(name.encode('utf-8')).hexdigest()}\n", '', 0
+
+    if command in ("start", "stop", "rm", "rmi"):
+        name = args[-1]
+        if command == "rmi":
+            error = remove_image(state, name)
+            if error is not None:
+                return '', f"Error response from daemon: {error}\n", 1
+            return f"Untagged: {get_reference(name)}\n", '', 0
+        if name not in state["containers"]:
+            return '', f"Error: No such container: {name}\n", 1
+        if command == "rm":
+            del state["containers"][name]
+        else:
+            state["containers"][name]["status"] = "Up Less than a second" if command == "start" else \
+                "Exited (0) Less than a second ago"
+        return f"{name}\n", '', 0
+
+    if command == "exec":
+        name = get_positionals(args, {"-u", "--user", "-w", "--workdir", "-e", "--env"})[0]
+        if not state["containers"].get(name, {}).get("status", '').startswith("Up"):
+            return '', f"Error response from daemon: Container {name} is not running\n", 1
+        return '', '', 0
+
+    return '', f"fake docker: unsupported command {command}\n", 1
+
+
+class CountingWriter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.writer.write(data)
+
+
+def add_member(archive, name, content=None):
+    info = tarfile.TarInfo(name)
+    info.mtime = 0
+    if content is None:
+        info.type, info.mode = tarfile.DIRTYPE, 0o755
+        archive.addfile(info)
+    else:
+        info.size, info.mode = len(content), 0o644
+        archive.addfile(info, io.BytesIO(content))
+
+
+def save(names, state, writer):
+    """Writes the images to a docker archive (in the format of docker before 25.0), and returns the stderr and the
+    return code."""
+    images = {get_reference(name): state["images"].get(get_reference(name)) for name in names}
+    for image in images.values():
+        if image is None:
+            return "Error response from daemon: reference does not exist\n", 1
+
+    with tarfile.open(fileobj=writer, mode="w|") as archive:
+        manifest, written = [], set()
+        for reference, image in images.items():
+            chain, paths = '', []
+            for layer in image["layers"]:
+                chain = hashlib.sha256(f"{chain} {layer}".encode('utf-8')).hexdigest()
+                paths.append(f"{chain}/layer.tar")
+                if chain not in written:
+                    written.add(chain)
+                    add_member(archive, f"{chain}/")
+                    add_member(archive, f"{chain}/VERSION", b"1.0")
+                    add_member(archive, f"{chain}/json", json.dumps({"id": chain}).encode('utf-8'))
+                    add_member(archive, f"{chain}/layer.tar", get_layer_content(state["layers"][layer]))
+            add_member(archive, f"{image['id'][7:]}.json", get_image_config(image))
+            manifest.append({"Config": f"{image['id'][7:]}.json", "RepoTags": [reference], "Layers": paths})
+        add_member(archive, "manifest.json", json.dumps(manifest).encode('utf-8'))
+        repositories = {reference.rsplit(':', 1)[0]: {reference.rsplit(':', 1)[1]: paths[-1].split('/')[0]}
+                        for reference in images}
+        add_member(archive, "repositories", json.dumps(repositories).encode('utf-8'))
+    return '', 0
+
+
+def load(state, reader):
+    """Loads the images of a docker archive read from stdin. Like docker, layers whose chain is already on the host
+    may be left out of the archive."""
+    contents = dict()
+    with tarfile.open(fileobj=reader, mode="r|") as archive:
+        for member in archive:
+            if member.isfile():
+                contents[member.name] = archive.extractfile(member).read()
+
+    lines = []
+    for entry in json.loads(contents["manifest.json"]):
+        config = json.loads(contents[entry["Config"]])
+        layers = config["rootfs"]["diff_ids"]
+        for index, (layer, path) in enumerate(zip(layers, entry["Layers"])):
+            if any(image["layers"][:index + 1] == layers[:index + 1] for image in state["images"].values()):
+                continue
+            if path not in contents:
+                return '', f"open /var/lib/docker/tmp/docker-import-0123/{path}: no such file or directory\n", 1
+            if f"sha256:{hashlib.sha256(contents[path]).hexdigest()}" != layer:
+                return '', f"Error processing tar file: layer {layer} does not match its content\n", 1
+            os.makedirs(os.path.join(HOME, "layers"), exist_ok=True)
+            with open(os.path.join(HOME, "layers", layer[7:]), "wb") as writer:
+                writer.write(contents[path])
+            state["layers"][layer] = {"file": layer[7:], "size": len(contents[path])}
+        for reference in entry["RepoTags"]:
+            add_image(state, reference, config["config"]["Labels"], env=config["config"]["Env"], layers=layers)
+            lines.append(f"Loaded image: {reference}")
+    return ''.join(f"{line}\n" for line in lines), '', 0
+
+
+def wait_latency():
+    with open(os.path.join(HOME, "host.json"), "r") as reader:
+        host = json.load(reader)
+    time.sleep(host.get("latency", 0.0))
+
+
+@contextlib.contextmanager
+def lock_state():
+    """Yields the state of the simulated host, which concurrent invocations (of libraries run in parallel, or of the
+    stand-in engine API) update one at a time."""
+    with open(os.path.join(HOME, "state.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(os.path.join(HOME, "state.json"), "r") as reader:
+            yield json.load(reader)
+
+
+def write_state(state):
+    with open(os.path.join(HOME, "state.json.tmp"), "w") as writer:
+        json.dump(state, writer)
+    os.replace(os.path.join(HOME, "state.json.tmp"), os.path.join(HOME, "state.json"))
+
+
+def record_call(args, start_time, stdout_bytes, stderr_bytes, return_code):
+    record = {"args": args, "start": start_time, "time": time.time() - start_time, "stdout_bytes": stdout_bytes,
+              "stderr_bytes": stderr_bytes, "return_code": return_code}
+    with open(os.path.join(HOME, "calls.jsonl"), "a") as writer:
+        writer.write(json.dumps(record) + "\n")
+
+
+def main(args):
+    start_time = time.time()
+    wait_latency()
+    with lock_state() as state:
+        if args[0] == "save":
+            writer = CountingWriter(sys.stdout.buffer)
+            stderr, return_code = save(get_positionals(args[1:], {"-o", "--output"}), state, writer)
+            stdout, stdout_bytes = '', writer.count
+        else:
+            stdout, stderr, return_code = execute(args, state) if args[0] != "load" else load(state, sys.stdin.buffer)
+            stdout_bytes = len(stdout.encode('utf-8'))
+        if return_code == 0 and args[0] in ("build", "pull", "run", "start", "stop", "rm", "rmi", "load"):
+            write_state(state)
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    record_call(args, start_time, stdout_bytes, len(stderr.encode('utf-8')), return_code)
+    return return_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
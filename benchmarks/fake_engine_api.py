@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Stand-in Docker Engine API server for benchmarking curator's ``api`` backend without a docker daemon.
+
+It serves the engine API on a unix socket from the simulated host of ``fake_docker.py``, so the host under
+``$FAKE_DOCKER_HOME`` can be shared with the stand-in docker executable (which runs the ``docker exec`` of ``attach``).
+Every request waits for the latency of the host and is appended to ``$FAKE_DOCKER_HOME/calls.jsonl`` like an
+invocation of ``fake_docker.py``, with the endpoint as its command. Only the endpoints used by curator are understood.
+
+Containers are created from the spec built by curator, which is checked like the engine checks it and kept in the
+state under ``spec``. The changes made through the API are streamed by ``/events``.
+
+    python3 fake_engine_api.py /path/to/docker.sock
+"""
+
+import fnmatch
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import socketserver
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+
+import fake_docker
+
+API_VERSION = "1.43"
+# Keys of the container specs and of their host configs built by curator
+SPEC_KEYS = {"Image", "Tty", "OpenStdin", "Env", "Labels", "ExposedPorts", "HostConfig", "User", "Hostname",
+             "WorkingDir", "Entrypoint"}
+HOST_CONFIG_KEYS = {"Binds", "PortBindings", "Devices", "CapAdd", "CapDrop", "SecurityOpt", "NetworkMode",
+                    "DeviceRequests", "Privileged", "ShmSize", "IpcMode"}
+
+# Events of the changes made through the API, which are streamed to the subscribers of ``/events``
+EVENTS = []
+EVENTS_CONDITION = threading.Condition()
+
+
+class Messages(list):
+    """Messages streamed as lines of JSON, like the progress of a build or a load."""
+    pass
+
+
+class EngineError(Exception):
+    def __init__(self, status, message):
+        super(EngineError, self).__init__(message)
+        self.status = status
+
+
+def add_event(event_type, action, actor, **attributes):
+    now = time.time()
+    with EVENTS_CONDITION:
+        EVENTS.append({"Type": event_type, "Action": action, "Actor": {"ID": actor, "Attributes": attributes},
+                       "time": int(now), "timeNano": int(now * 1e9)})
+        EVENTS_CONDITION.notify_all()
+
+
+def check_spec(spec):
+    """Checks a container spec as the engine does, and raises ``EngineError`` if it is invalid."""
+    host_config = spec.get("HostConfig", {})
+    unknown = (set(spec) - SPEC_KEYS) | (set(host_config) - HOST_CONFIG_KEYS)
+    if unknown:
+        raise EngineError(400, f"fake engine: unsupported container options {sorted(unknown)}")
+    for bind in host_config.get("Binds", []):
+        parts = bind.split(':')
+        if len(parts) not in (2, 3) or not os.path.isabs(parts[1]) or parts[2:] not in ([], ["ro"], ["rw"]):
+            raise EngineError(400, f"invalid volume specification: '{bind}'")
+    for port, bindings in host_config.get("PortBindings", {}).items():
+        if not re.fullmatch(r"\d+/(tcp|udp|sctp)", port) or port not in spec.get("ExposedPorts", {}):
+            raise EngineError(400, f"invalid port specification: \"{port}\"")
+        if any(not re.fullmatch(r"\d*", binding.get("HostPort", '')) for binding in bindings):
+            raise EngineError(400, f"invalid port bindings of \"{port}\": {bindings}")
+    for device in host_config.get("Devices", []):
+        if not os.path.isabs(device.get("PathOnHost", '')) or not os.path.isabs(device.get("PathInContainer", '')):
+            raise EngineError(400, f"invalid device mapping: {device}")
+    for variable in spec.get("Env", []):
+        if '=' not in variable:
+            raise EngineError(400, f"invalid environment variable: \"{variable}\"")
+    if not isinstance(host_config.get("ShmSize", 0), int) or host_config.get("ShmSize", 0) < 0:
+        raise EngineError(400, f"invalid shm size: {host_config['ShmSize']}")
+    if any(not isinstance(value, str) for value in spec.get("Labels", {}).values()):
+        raise EngineError(400, f"invalid labels: {spec['Labels']}")
+
+
+def get_container_record(state, name, container, use_size=False):
+    image = state["images"].get(fake_docker.get_reference(container["image"]))
+    record = {"Id": hashlib.sha256(name.encode('utf-8')).hexdigest(), "Names": [f"/{name}"],
+              "Image": container["image"], "ImageID": image["id"] if image is not None else '',
+              "State": "running" if container["status"].startswith("Up") else container["status"].split()[0].lower(),
+              "Status": container["status"], "Labels": container["labels"]}
+    if use_size:
+        record["SizeRw"] = container.get("size", 0)
+    return record
+
+
+def get_version(state, query, body):
+    return {"Version": fake_docker.VERSION, "ApiVersion": API_VERSION}
+
+
+def list_images(state, query, body):
+    patterns = json.loads(query.get("filters", "{}")).get("reference", [])
+    return [{"Id": image["id"], "RepoTags": [reference], "Size": image["size"], "Labels": image["labels"]}
+            for reference, image in state["images"].items()
+            if not patterns or any(fnmatch.fnmatchcase(reference, fake_docker.get_reference(pattern))
+                                   for pattern in patterns)]
+
+
+def inspect_image(state, query, body, name):
+    image = state["images"].get(fake_docker.get_reference(name))
+    if image is None:
+        raise EngineError(404, f"No such image: {name}")
+    return fake_docker.get_image_record(fake_docker.get_reference(name), image)
+
+
+def save_image(state, query, body, name):
+    writer = io.BytesIO()
+    stderr, return_code = fake_docker.save([name], state, writer)
+    if return_code != 0:
+        raise EngineError(404, stderr.strip())
+    return writer.getvalue()
+
+
+def load_image(state, query, body):
+    stdout, stderr, return_code = fake_docker.load(state, io.BytesIO(body))
+    if return_code != 0:
+        # Errors of a started load are streamed instead of returned as the status
+        return Messages([{"errorDetail": {"message": stderr.strip()}, "error": stderr.strip()}])
+    for line in stdout.splitlines():
+        reference = line[len("Loaded image: "):]
+        add_event("image", "load", state["images"][reference]["id"], name=reference)
+    return Messages({"stream": f"{line}\n"} for line in stdout.splitlines())
+
+
+def pull_image(state, query, body):
+    name = f"{query['fromImage']}:{query['tag']}" if query.get("tag") else query["fromImage"]
+    lines = fake_docker.pull(state, name)
+    add_event("image", "pull", fake_docker.get_reference(name), name=fake_docker.get_reference(name))
+    return Messages({"status": line} for line in lines)
+
+
+def remove_image(state, query, body, name):
+    image = state["images"].get(fake_docker.get_reference(name))
+    error = fake_docker.remove_image(state, name)
+    if error is not None:
+        raise EngineError(404 if image is None else 409, error)
+    add_event("image", "untag", image["id"], name=fake_docker.get_reference(name))
+    return [{"Untagged": fake_docker.get_reference(name)}]
+
+
+def build_image(state, query, body):
+    labels, tag = json.loads(query.get("labels", "{}")), query["t"]
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r") as archive:
+        content = archive.extractfile(query.get("dockerfile", "Dockerfile")).read().decode('utf-8')
+    instructions = [line.strip() for line in content.splitlines() if line.strip() and not line.startswith('#')]
+    lines = fake_docker.build(state, tag, labels, instructions, use_no_cache=query.get("nocache") in ("1", "true"))
+    image = state["images"][fake_docker.get_reference(tag)]
+    add_event("image", "tag", image["id"], name=fake_docker.get_reference(tag))
+    return Messages([{"stream": f"{line}\n"} for line in lines] + [{"aux": {"ID": image["id"]}}])
+
+
+def list_containers(state, query, body):
+    filters = json.loads(query.get("filters", "{}"))
+    records = []
+    for name, container in state["containers"].items():
+        if any(not re.search(pattern, f"/{name}") for pattern in filters.get("name", [])):
+            continue
+        if any(label.split('=', 1)[0] not in container["labels"] or
+               ('=' in label and container["labels"][label.split('=', 1)[0]] != label.split('=', 1)[1])
+               for label in filters.get("label", [])):
+            continue
+        if query.get("all") not in ("1", "true") and not container["status"].startswith("Up"):
+            continue
+        records.append(get_container_record(state, name, container, use_size=query.get("size") in ("1", "true")))
+    return records
+
+
+def create_container(state, query, body):
+    name, spec = query["name"], json.loads(body)
+    check_spec(spec)
+    error = fake_docker.create_container(state, name, spec["Image"], spec.get("Labels", {}), spec=spec)
+    if error is not None:
+        raise EngineError(409 if name in state["containers"] else 404, error)
+    state["containers"][name]["status"] = "Created"
+    add_event("container", "create", name, name=name, image=spec["Image"])
+    return {"Id": hashlib.sha256(name.encode('utf-8')).hexdigest(), "Warnings": []}
+
+
+def start_container(state, query, body, name):
+    container = get_container(state, name)
+    if container["status"].startswith("Up"):
+        return None, 304
+    container["status"] = "Up Less than a second"
+    add_event("container", "start", name, name=name, image=container["image"])
+    return None, 204
+
+
+def stop_container(state, query, body, name):
+    container = get_container(state, name)
+    if not container["status"].startswith("Up"):
+        return None, 304
+    container["status"] = "Exited (0) Less than a second ago"
+    add_event("container", "die", name, name=name, image=container["image"])
+    add_event("container", "stop", name, name=name, image=container["image"])
+    return None, 204
+
+
+def remove_container(state, query, body, name):
+    container = get_container(state, name)
+    if container["status"].startswith("Up"):
+        raise EngineError(409, f"You cannot remove a running container {name}. Stop the container before attempting "
+                               f"removal or force remove")
+    del state["containers"][name]
+    add_event("container", "destroy", name, name=name, image=container["image"])
+    return None, 204
+
+
+def get_container(state, name):
+    if name not in state["containers"]:
+        raise EngineError(404, f"No such container: {name}")
+    return state["containers"][name]
+
+
+def get_disk_usage(state, query, body):
+    layers = {layer for image in state["images"].values() for layer in image["layers"]}
+    return {"LayersSize": sum(state["layers"][layer]["size"] for layer in layers),
+            "Images": list_images(state, {}, None),
+            "Containers": [get_container_record(state, name, container, use_size=True)
+                           for name, container in state["containers"].items()]}
+
+
+# Endpoints (after the optional version prefix) with their handlers, and whether they change the state
+ROUTES = [
+    ("GET", r"/version", get_version, False),
+    ("GET", r"/images/json", list_images, False),
+    ("GET", r"/images/(?P<name>.+)/json", inspect_image, False),
+    ("GET", r"/images/(?P<name>.+)/get", save_image, False),
+    ("POST", r"/images/load", load_image, True),
+    ("POST", r"/images/create", pull_image, True),
+    ("DELETE", r"/images/(?P<name>.+)", remove_image, True),
+    ("POST", r"/build", build_image, True),
+    ("GET", r"/containers/json", list_containers, False),
+    ("POST", r"/containers/create", create_container, True),
+    ("POST", r"/containers/(?P<name>[^/]+)/start", start_container, True),
+    ("POST", r"/containers/(?P<name>[^/]+)/stop", stop_container, True),
+    ("DELETE", r"/containers/(?P<name>[^/]+)", remove_container, True),
+    ("GET", r"/system/df", get_disk_usage, False),
+]
+
+
+class EngineHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                return b''.join(chunks)
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Api-Version", API_VERSION)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        start_time = time.time()
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r"^/v\d+\.\d+(?=/)", '', url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self.read_body()
+        if method == "GET" and path == "/events":
+            fake_docker.record_call([f"{method} {path}"], start_time, 0, 0, 0)
+            return self.stream_events(query)
+
+        fake_docker.wait_latency()
+        status, response, endpoint = 404, {"message": f"page not found: {method} {path}"}, path
+        for route_method, pattern, handler, is_mutating in ROUTES:
+            matched = re.fullmatch(pattern, path)
+            if route_method != method or matched is None:
+                continue
+            endpoint = pattern.replace("(?P<name>.+)", "{name}").replace("(?P<name>[^/]+)", "{name}")
+            arguments = {key: urllib.parse.unquote(value) for key, value in matched.groupdict().items()}
+            with fake_docker.lock_state() as state:
+                try:
+                    status, response = 200, handler(state, query, body, **arguments)
+                    if isinstance(response, tuple):
+                        response, status = response
+                    if is_mutating:
+                        fake_docker.write_state(state)
+                except EngineError as e:
+                    status, response = e.status, {"message": str(e)}
+            break
+
+        content_type = "application/json"
+        if status in (204, 304) or response is None:
+            body = b''
+        elif isinstance(response, bytes):
+            body, content_type = response, "application/x-tar"
+        elif isinstance(response, Messages):
+            body = ''.join(json.dumps(message) + "\r\n" for message in response).encode('utf-8')
+        else:
+            body = json.dumps(response).encode('utf-8')
+        self.send_body(status, body, content_type)
+        fake_docker.record_call([f"{method} {endpoint}"], start_time, len(body), 0, 0 if status < 400 else status)
+
+    def stream_events(self, query):
+        since = float(query["since"]) if "since" in query else time.time()
+        types = json.loads(query.get("filters", "{}")).get("type")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.flush()
+        index = 0
+        while True:
+            with EVENTS_CONDITION:
+                while index >= len(EVENTS):
+                    EVENTS_CONDITION.wait()
+                events, index = EVENTS[index:], len(EVENTS)
+            for event in events:
+                if event["time"] < since or (types and event["Type"] not in types):
+                    continue
+                line = json.dumps(event).encode('utf-8') + b"\n"
+                try:
+                    self.wfile.write(f"{len(line):x}\r\n".encode('utf-8') + line + b"\r\n")
+                    self.wfile.flush()
+                except OSError:
+                    return
+
+
+class EngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(args):
+    if len(args) != 1:
+        print(f"Usage: {sys.argv[0]} SOCKET", file=sys.stderr)
+        return 2
+    if os.path.exists(args[0]):
+        os.remove(args[0])
+    with EngineServer(args[0], EngineHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args[0])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
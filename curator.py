@@ -1,72 +1,1807 @@
+import abc
 import argparse
+import base64
 import collections
+import concurrent.futures
+import functools
 import glob
+import hashlib
+import http.client
+import io
 import logging
 import os
 import re
+import select
 import shutil
+import signal
 import socket
 import string
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
 
 import packaging.version
 
-from pytools.pyutils.io.file_system import get_absolute_path
-from pytools.pyutils.io.pretty import load_json, loads_json
+try:
+    import zstandard
+except ModuleNotFoundError:
+    # Layer stores are compressed with the zstd executable instead
+    zstandard = None
+
+from pytools.pyutils.io.file_system import get_absolute_path, mkdir
+from pytools.pyutils.io.pretty import dump_json, dumps_json, dumps_table, load_json, loads_json
 from pytools.pyutils.logging.logger import get_default_logger
 from pytools.pyutils.misc.nested import AttrListDictifier, ListDictMerger
-from pytools.pyutils.misc.decorator import cached_property
+from pytools.pyutils.misc.decorator import synchronized_member_fn
 from pytools.pyutils.misc.string import row_pad_prefix
 
-DEFAULT_CONFIG = AttrListDictifier().dictify({
-    "dockers": {},
-    "library": {
-        "name": None,
-        "arguments": {}
-    },
-    "runtime": {
-        "name": None,
-        "mounts": {},
-        "devices": [],
-        "networks": {},
-        "environment": {},
-        "attributes": {
-            "use_gpus": False,
-            "use_privileged": False,
-            "use_user_permission": False,
-            "use_hostname": False
-        },
-        "extra_args": [],
-        "attach_entrypoint": "/bin/bash"
-    },
-    "preset": {
-        "runtime": {
-            "mounts": {},
-            "networks": {}
-        }
-    }
-})
+from curatorc import DAEMON_SOCKET, make_private_directory, run_client
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+
+CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "curator")
+
+FINGERPRINT_LABEL = "curator.fingerprint"
+# Containers inherit the labels of their images, so the fingerprint of a container has its own label
+RUN_FINGERPRINT_LABEL = "curator.run_fingerprint"
+
+# Number of the latest output lines of a streamed command kept for its failure report
+FAILURE_REPORT_LINES = 100
+
+# Seconds before a hanging mount source probe is considered as failed, and how long it is remembered as dead
+MOUNT_PROBE_TIMEOUT = 5.0
+MOUNT_DEAD_SOURCE_TTL = 600.0
+
+# Seconds before a hanging docker version probe is considered as failed, and how long a failed probe is remembered
+DOCKER_PROBE_TIMEOUT = 5.0
+DOCKER_PROBE_FAILURE_TTL = 600.0
+
+# Zstd level of the blobs of layer stores, the size of the chunks streamed through them, and the size below which the
+# files of an image archive are kept in the manifest of its library instead
+LAYER_STORE_COMPRESSION_LEVEL = 3
+LAYER_STORE_CHUNK_SIZE = 1 << 20
+LAYER_STORE_INLINE_SIZE = 64 << 10
+
+# Longest seconds between the reconnections of the daemon to the events of a docker daemon
+DAEMON_EVENTS_RETRY_DELAY = 60.0
+# Actions of docker events which change the listed containers and images, the others (exec, attach, resize, health
+# checks, ...) are ignored
+DAEMON_CONTAINER_ACTIONS = frozenset(["create", "start", "stop", "die", "destroy", "rename", "pause", "unpause"])
+DAEMON_IMAGE_ACTIONS = frozenset(["tag", "untag", "delete", "pull", "load", "import"])
+
+# Serializes interactive prompts of libraries running concurrently
+INPUT_LOCK = threading.Lock()
+
+# The daemon of this process if it is serving actions (``curator.py daemon``), whose backends are reused
+SERVING_DAEMON = None
+
+DEFAULT_CONFIG = AttrListDictifier().dictify({
+    "dockers": {},
+    "library": {
+        "name": None,
+        "arguments": {}
+    },
+    "runtime": {
+        "name": None,
+        "mounts": {},
+        "devices": [],
+        "networks": {},
+        "environment": {},
+        "attributes": {
+            "use_gpus": False,
+            "use_privileged": False,
+            "use_user_permission": False,
+            "use_hostname": False
+        },
+        "extra_args": [],
+        "attach_entrypoint": "/bin/bash"
+    },
+    "preset": {
+        "runtime": {
+            "mounts": {},
+            "networks": {}
+        }
+    }
+})
+
+
+ImageInfo = collections.namedtuple("ImageInfo", ['reference', 'id'])
+ContainerInfo = collections.namedtuple("ContainerInfo", ['name', 'image', 'status', 'fingerprint'])
+
+
+def get_image_reference(name):
+    if ':' not in name.rsplit('/', 1)[-1] and '@' not in name:
+        return f"{name}:latest"
+    return name
+
+
+def get_cache_path(*names):
+    path = os.path.join(CACHE_DIRECTORY, *names)
+    mkdir(os.path.dirname(path))
+    return path
+
+
+def dump_json_atomically(path, data):
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    dump_json(temporary_path, data)
+    os.replace(temporary_path, path)
+
+
+class ProfileSpan(object):
+    """A timed phase of curator, whose ``args`` (such as return codes and output sizes) can be filled while open."""
+
+    __slots__ = ("_profiler", "name", "category", "args", "_start_time")
+
+    def __init__(self, profiler, name, category, args):
+        self._profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self._profiler.record(self, self._start_time, time.perf_counter())
+
+
+class NullProfileSpan(object):
+    """The span of a disabled profiler, which records nothing."""
+
+    @property
+    def args(self):
+        # The span is shared by all threads, so every caller gets its own dict to throw away
+        return dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return None
+
+
+class Profiler(object):
+    """Records the spans of curator's phases and docker calls, which are written in the Chrome trace-event format.
+
+    Until it is enabled (by ``--profile``), ``span`` only returns a shared span that records nothing.
+    """
+
+    NULL_SPAN = NullProfileSpan()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._is_enabled = False
+        self._origin = time.perf_counter()
+        self._events = []
+        self._thread_names = dict()
+
+    @property
+    def is_enabled(self):
+        return self._is_enabled
+
+    def enable(self):
+        self._is_enabled = True
+
+    def span(self, name, category="curator", **args):
+        if not self._is_enabled:
+            return self.NULL_SPAN
+        return ProfileSpan(self, name, category, args)
+
+    def record(self, span, start_time, end_time):
+        # Build arguments may be secrets asked interactively, so their values are not written to the trace
+        if "argv" in span.args:
+            span.args["argv"] = [f"{value.split('=', 1)[0]}=***" if option == "--build-arg" else value
+                                 for option, value in zip([None] + span.args["argv"], span.args["argv"])]
+        if span.args.get("query") and "buildargs" in span.args["query"]:
+            span.args["query"] = dict(span.args["query"], buildargs="***")
+        thread = threading.current_thread()
+        with self._lock:
+            self._thread_names.setdefault(thread.ident, thread.name)
+            self._events.append({
+                "name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                "ts": (start_time - self._origin) * 1e6, "dur": (end_time - start_time) * 1e6, "args": span.args
+            })
+
+    def dump(self, path):
+        with self._lock:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                        for ident, name in self._thread_names.items()]
+            dump_json(path, {"traceEvents": metadata + self._events, "displayTimeUnit": "ms"})
+
+    def dumps_summary(self):
+        """Returns a table of the count, the total and the longest duration of the spans of every name."""
+        summary = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        with self._lock:
+            for event in self._events:
+                entry, duration = summary[event["name"]], event["dur"] / 1e6
+                entry[0], entry[1], entry[2] = entry[0] + 1, entry[1] + duration, max(entry[2], duration)
+        rows = sorted(summary.items(), key=lambda item: item[1][1], reverse=True)
+        return dumps_table({name: f"{count:>4}x  total {total:8.3f}s  max {longest:8.3f}s"
+                            for name, (count, total, longest) in rows}, indent=4)
+
+
+# Spans are only recorded with --profile, otherwise the cost of a span is the call of ``PROFILER.span``
+PROFILER = Profiler()
+
+
+def profiled(name):
+    """Decorates a function whose calls are recorded as spans of the given name."""
+    def wrapper(fn):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with PROFILER.span(name):
+                return fn(*args, **kwargs)
+        return wrapped
+    return wrapper
+
+
+class FileHashCache(object):
+    """Caches the sha256 digests of files, which are only read again when their mtime or size changes."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._is_dirty = False
+        try:
+            self._digests = load_json(path)
+        except (OSError, ValueError):
+            self._digests = dict()
+
+    def get_digest(self, path):
+        path = get_absolute_path(path)
+        stat = os.lstat(path)
+        if os.path.islink(path):
+            return hashlib.sha256(os.readlink(path).encode('utf-8')).hexdigest()
+
+        key = [stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            entry = self._digests.get(path)
+            if entry is not None and entry[:2] == key:
+                return entry[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as reader:
+            for chunk in iter(lambda: reader.read(1 << 20), b''):
+                digest.update(chunk)
+        with self._lock:
+            self._digests[path] = key + [digest.hexdigest()]
+            self._is_dirty = True
+        return digest.hexdigest()
+
+    def save(self):
+        with self._lock:
+            if self._is_dirty:
+                dump_json_atomically(self._path, self._digests)
+                self._is_dirty = False
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_hash_cache():
+    return FileHashCache(get_cache_path("file_hashes.json"))
+
+
+def _compile_dockerignore_pattern(pattern):
+    regex, index = '', 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex, index = regex + "(?:.*/)?", index + 3
+            continue
+        if pattern.startswith("**", index):
+            regex, index = regex + ".*", index + 2
+            continue
+        character = pattern[index]
+        if character == '*':
+            regex += "[^/]*"
+        elif character == '?':
+            regex += "[^/]"
+        elif character == '[' and ']' in pattern[index + 1:]:
+            end = pattern.index(']', index + 1)
+            regex += '[' + pattern[index + 1:end] + ']'
+            index = end
+        elif character == '\\' and index + 1 < len(pattern):
+            index += 1
+            regex += re.escape(pattern[index])
+        else:
+            regex += re.escape(character)
+        index += 1
+    # Excluding a directory excludes everything under it as well
+    return re.compile(regex + "(?:/.*)?")
+
+
+def get_context_files(path):
+    """Returns the relative paths of the files sent to the daemon as the build context, following ``.dockerignore``.
+    Symlinks are sent as links, including the ones to directories."""
+    patterns = []
+    if os.path.isfile(os.path.join(path, ".dockerignore")):
+        with open(os.path.join(path, ".dockerignore"), "r") as reader:
+            for line in reader:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                is_exception = line.startswith('!')
+                line = os.path.normpath(line.lstrip('!').strip()).lstrip('/')
+                patterns.append((_compile_dockerignore_pattern(line), is_exception))
+    has_exceptions = any(is_exception for _, is_exception in patterns)
+
+    def is_ignored(relative_path):
+        result = False
+        for pattern, is_exception in patterns:
+            if pattern.fullmatch(relative_path):
+                result = not is_exception
+        return result
+
+    files = []
+    for root, dirs, names in os.walk(path):
+        relative_root = os.path.relpath(root, path)
+        relative_root = '' if relative_root == '.' else relative_root + '/'
+        if not has_exceptions:
+            dirs[:] = [name for name in dirs if not is_ignored(relative_root + name)]
+        # Symlinks to directories are listed in dirs, and are not walked into
+        for name in dirs:
+            if os.path.islink(os.path.join(root, name)) and not is_ignored(relative_root + name):
+                files.append(relative_root + name)
+        for name in names:
+            if not is_ignored(relative_root + name):
+                files.append(relative_root + name)
+    for name in ("Dockerfile", ".dockerignore"):
+        # These two files are always sent to the daemon
+        if name not in files and os.path.isfile(os.path.join(path, name)):
+            files.append(name)
+    return sorted(files)
+
+
+def get_build_arguments(config, use_prompt=True):
+    args = dict()
+    for key, value in config.library.arguments.items():
+        if value is None:
+            if not use_prompt:
+                continue
+            with INPUT_LOCK:
+                value = input(f"Please input the build argument {key}: ")
+        elif value.startswith("$%"):
+            value = value[2:]
+            if value == "EUID":
+                value = os.geteuid()
+            elif value == "EGID":
+                value = os.getegid()
+            elif value == "UID":
+                value = os.getuid()
+            elif value == "GID":
+                value = os.getgid()
+            else:
+                raise ValueError(f"Unrecognized builtin variable \"{value}\"")
+        elif value.startswith("$"):
+            value = os.environ[value[1:]]
+        args[key] = str(value)
+    return args
+
+
+def get_library_manifest_path(path):
+    key = hashlib.sha256(get_absolute_path(path, use_real_path=True).encode('utf-8')).hexdigest()
+    return get_cache_path("manifests", f"{key[:32]}.json")
+
+
+def load_library_manifest(path):
+    manifest_path = get_library_manifest_path(path)
+    return load_json(manifest_path) if os.path.isfile(manifest_path) else None
+
+
+def get_library_usage_path(name):
+    file_name = urllib.parse.quote(get_image_reference(name), safe='')
+    return get_cache_path("usage", f"{file_name}.{socket.gethostname()}.json")
+
+
+def load_library_usages():
+    """Returns the usage records of the libraries of this host by their image references (see
+    ``Docker.collect_garbage``)."""
+    records = dict()
+    for path in glob.glob(os.path.join(CACHE_DIRECTORY, "usage", f"*.{glob.escape(socket.gethostname())}.json")):
+        try:
+            record = load_json(path)
+        except (OSError, ValueError):
+            continue
+        if record.get("host") == socket.gethostname():
+            records[record["library"]] = record
+    return records
+
+
+def get_fingerprint(data):
+    return hashlib.sha256(dumps_json(data, indent=None, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def collect_library_inputs(path, arguments, bases):
+    """Collects the digests of everything the image of the library at ``path`` is built from, given its build
+    arguments (other than the interactive ones) and the image IDs of its base images."""
+    hash_cache = get_file_hash_cache()
+    context = dict()
+    for relative_path in get_context_files(path):
+        if relative_path != "Dockerfile":
+            mode = os.lstat(os.path.join(path, relative_path)).st_mode
+            context[relative_path] = f"{mode:o}:{hash_cache.get_digest(os.path.join(path, relative_path))}"
+    dockerfile = hash_cache.get_digest(os.path.join(path, "Dockerfile"))
+    hash_cache.save()
+
+    arguments = {key: hashlib.sha256(value.encode('utf-8')).hexdigest() for key, value in arguments.items()}
+    return {"dockerfile": dockerfile, "context": context, "arguments": arguments, "bases": dict(bases)}
+
+
+def get_input_changes(previous, current):
+    changes = []
+    if previous["dockerfile"] != current["dockerfile"]:
+        changes.append("Dockerfile is changed")
+    for kind, description in (("context", "context file"), ("arguments", "build argument"), ("bases", "base image")):
+        for key in sorted(set(previous[kind]) | set(current[kind])):
+            if key not in previous[kind]:
+                changes.append(f"{description} \"{key}\" is added")
+            elif key not in current[kind]:
+                changes.append(f"{description} \"{key}\" is removed")
+            elif previous[kind][key] != current[kind][key]:
+                changes.append(f"{description} \"{key}\" is changed")
+    return changes
+
+
+MountProbe = collections.namedtuple("MountProbe", ['path', 'status', 'latency'])
+
+
+def probe_concurrently(items, fn, timeout):
+    """Calls ``fn`` on every item, each in its own thread, and returns the results of the calls which have returned
+    within ``timeout`` seconds by their items. ``fn`` is expected to catch its own errors."""
+    results, threads = dict(), dict()
+
+    def call(item):
+        results[item] = fn(item)
+
+    for item in dict.fromkeys(items):
+        # Daemon threads are never joined at exit, so a call stuck in the kernel or on a hung process cannot hang
+        # curator
+        threads[item] = threading.Thread(target=call, args=(item,), daemon=True)
+        threads[item].start()
+
+    deadline = time.time() + timeout
+    for thread in threads.values():
+        thread.join(max(0.0, deadline - time.time()))
+    # Late calls keep writing to ``results``, so only the items are read from it
+    return {item: results[item] for item in threads if item in results}
+
+
+class MountProber(object):
+    """Checks mount sources concurrently, each with a timeout, so that a hung network filesystem cannot block others.
+
+    Sources whose probe timed out (or failed with an error other than not existing) are remembered in a per-host
+    negative cache for ``dead_source_ttl`` seconds, and are skipped immediately in the meantime.
+    """
+
+    def __init__(self, logger: logging.Logger, timeout=MOUNT_PROBE_TIMEOUT, dead_source_ttl=MOUNT_DEAD_SOURCE_TTL):
+        self._logger = logger
+        self._timeout = timeout
+        self._dead_source_ttl = dead_source_ttl
+        self._cache_path = get_cache_path(f"dead_mounts.{socket.gethostname()}.json")
+
+    def _load_dead_sources(self):
+        try:
+            dead_sources = load_json(self._cache_path)
+        except (OSError, ValueError):
+            return dict()
+        current_time = time.time()
+        return {source: expiration for source, expiration in dead_sources.items() if expiration > current_time}
+
+    @staticmethod
+    def _probe_source(source):
+        start_time = time.time()
+        try:
+            path = os.path.realpath(source)
+            os.stat(path)
+            return MountProbe(path, "ok", time.time() - start_time)
+        except (FileNotFoundError, NotADirectoryError):
+            return MountProbe(None, "missing", time.time() - start_time)
+        except OSError:
+            return MountProbe(None, "dead", time.time() - start_time)
+
+    @profiled("probe_mounts")
+    def probe(self, sources):
+        """Returns a ``MountProbe`` for each source, whose ``path`` is the resolved real path when it exists."""
+        dead_sources = self._load_dead_sources()
+        sources = list(dict.fromkeys(sources))
+        probed_sources = [source for source in sources if source not in dead_sources]
+        probes = probe_concurrently(probed_sources, self._probe_source, self._timeout)
+        results = {source: MountProbe(None, "cached", 0.0) if source in dead_sources else
+                   probes.get(source, MountProbe(None, "timeout", self._timeout)) for source in sources}
+
+        expiration = time.time() + self._dead_source_ttl
+        new_dead_sources = {source: expiration for source in probed_sources
+                            if results[source].status in ("dead", "timeout")}
+        if new_dead_sources:
+            dump_json_atomically(self._cache_path, dict(self._load_dead_sources(), **new_dead_sources))
+
+        for source, result in results.items():
+            if result.status in ("ok", "missing"):
+                self._logger.info(f"Probed mount source \"{source}\" in {result.latency * 1000:.1f}ms "
+                                   f"({result.status})")
+            else:
+                self._logger.warning(f"Probed mount source \"{source}\" in {result.latency * 1000:.1f}ms "
+                                     f"({result.status}), which is skipped")
+        return results
+
+
+class RunPlan(collections.namedtuple("RunPlan", ['library', 'runtime', 'path', 'build_options', 'interactive_arguments',
+                                                 'run_options', 'build_labels', 'run_labels', 'preconditions',
+                                                 'stamp'])):
+    """Everything needed to build and start a library, as resolved from its configuration.
+
+    ``build_labels`` and ``run_labels`` are the fingerprint labels curator passes to ``docker build`` and ``docker
+    run``, which are set by ``label_run_plan`` and are left empty in the cached plans. ``preconditions`` holds the
+    filesystem facts the resolution depended on (``exists``, ``missing`` and ``glob``) and the image ``start``
+    builds before running (``image``). A container of the runtime which exists already is kept or replaced by
+    ``start`` according to its run fingerprint. ``stamp`` records the source files' mtimes and the environment the
+    plan was resolved in.
+    """
+
+    __slots__ = ()
+
+    @property
+    def build_command(self):
+        labels = tuple(option for key, value in self.build_labels for option in ("--label", f"{key}={value}"))
+        return ("build", "-t", self.library, self.path) + self.build_options + labels
+
+    @property
+    def run_command(self):
+        labels = tuple(f"--label={key}={value}" for key, value in self.run_labels)
+        return ("run", "-td", "--name", self.runtime) + self.run_options + labels + (self.library,)
+
+    def to_json(self):
+        result = self._asdict()
+        result["build"] = list(self.build_command)
+        result["run"] = list(self.run_command)
+        return result
+
+    @classmethod
+    def from_json(cls, data):
+        def freeze(value):
+            return tuple(map(freeze, value)) if isinstance(value, list) else value
+
+        return cls(**{field: data[field] if field == "stamp" else freeze(data[field]) for field in cls._fields})
+
+
+def get_run_fingerprint(plan: RunPlan, image):
+    """Fingerprints what a container is created from, namely the library's image (by ID) and the resolved run
+    options."""
+    return get_fingerprint({"image": image, "runtime": plan.runtime, "run_options": plan.run_options})
+
+
+def label_run_plan(plan: RunPlan, bases, image) -> RunPlan:
+    """Returns the plan with the labels curator passes to ``docker build`` and ``docker run``, which fingerprint the
+    current inputs of the library (given the image IDs of its bases) and its image (given its ID) with the run
+    options."""
+    arguments = dict(value.split('=', 1) for value in plan.build_options[1::2])
+    inputs = collect_library_inputs(plan.path, arguments, bases)
+    return plan._replace(build_labels=((FINGERPRINT_LABEL, get_fingerprint(inputs)),),
+                         run_labels=((RUN_FINGERPRINT_LABEL, get_run_fingerprint(plan, image)),))
+
+
+def get_recorded_library_variables(config):
+    """Returns the environment of a library's image recorded by its latest build, without the daemon."""
+    manifest = load_library_manifest(config.path)
+    if manifest is None or "variables" not in manifest:
+        raise RuntimeError(f"The environment of library \"{config.library.name}\" is not recorded, build the library "
+                           f"first")
+    return manifest["variables"]
+
+
+def label_run_plan_from_manifest(plan: RunPlan) -> RunPlan:
+    """Labels a plan without the daemon, with the image IDs recorded by the latest build of the library."""
+    manifest = load_library_manifest(plan.path)
+    if manifest is None:
+        return label_run_plan(plan, {base: None for base in get_library_bases(plan.path)}, None)
+    recorded_bases = manifest["inputs"]["bases"]
+    return label_run_plan(plan, {base: recorded_bases.get(base) for base in get_library_bases(plan.path)},
+                          manifest["image"])
+
+
+def get_referenced_variables(text):
+    names = set(re.findall(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)", text))
+    if text.startswith('~'):
+        names.add("HOME")
+    return names
+
+
+def get_environment_digest(name):
+    return hashlib.sha256(os.environ.get(name, "\0").encode('utf-8')).hexdigest()
+
+
+def get_run_plan_path(path):
+    key = f"{get_absolute_path(path, use_real_path=True)}\0{os.getcwd()}"
+    return get_cache_path("plans", f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}.json")
+
+
+@profiled("resolve_run_plan")
+def resolve_run_plan(config, get_library_variables, logger: logging.Logger, prober: MountProber = None):
+    """Resolves a library's configuration into a ``RunPlan``, leaving the configuration itself untouched.
+
+    The daemon is not queried here: ``get_library_variables`` is only called when mount targets need the library's
+    environment, and it usually reads them from the library manifest. All mount sources are probed at once, then
+    the first successful trial of every mount collection is taken in the declared order.
+    """
+    prober = prober or MountProber(logger)
+    variables, preconditions = set(), []
+
+    build_options, interactive_arguments = [], []
+    for key, value in config.library.arguments.items():
+        if value is None:
+            interactive_arguments.append(key)
+        elif value.startswith("$") and not value.startswith("$%"):
+            variables.add(value[1:])
+    for key, value in get_build_arguments(config, use_prompt=False).items():
+        build_options.extend(["--build-arg", f"{key}={value}"])
+
+    run_options = []
+
+    # Handling volume mounts
+    mounts = dict()
+    for name, trials in config.runtime.mounts.items():
+        if trials is None:
+            if name in config.preset.runtime.mounts:
+                trials = config.preset.runtime.mounts[name]
+            else:
+                logger.warning(f"Skipping mount \"{name}\", which is not a preset value")
+                continue
+        mounts[name] = trials
+        for trial in trials:
+            for option in trial:
+                variables.update(get_referenced_variables(option.source))
+
+    def get_source(option):
+        return get_absolute_path(os.path.expanduser(os.path.expandvars(option.source)))
+
+    probes = prober.probe([get_source(option) for trials in mounts.values() for trial in trials for option in trial])
+    library_variables = None
+    for name, trials in mounts.items():
+        for trial in trials:
+            sources = []
+            for option in trial:
+                probe = probes[get_source(option)]
+                if probe.path is None:
+                    preconditions.append(("missing", get_source(option)))
+                    break
+                sources.append(probe.path)
+            else:
+                if library_variables is None:
+                    library_variables = get_library_variables()
+                for source, option in zip(sources, trial):
+                    preconditions.append(("exists", source))
+                    target = string.Template(option.target).substitute(library_variables)
+                    run_options.extend(["-v", f"{source}:{target}:{option.mode}"])
+                break
+        else:
+            logger.warning(f"All trials on mounting collection \"{name}\" are failed")
+
+    # Handling network mappings
+    networks = config.runtime.networks
+    if networks == "host":
+        run_options.extend(["--net", "host"])
+    else:
+        if isinstance(networks, str):
+            networks = config.preset.runtime.networks[networks]
+
+        if isinstance(networks, dict):
+            for k, v in networks.items():
+                run_options.extend(['-p', f"{k}:{v}"])
+        else:
+            raise ValueError("Runtime network setting cannot be analyzed")
+
+    # Handling device pass-through
+    devices = config.runtime.devices
+    if isinstance(devices, str):
+        devices = config.preset.runtime.devices[devices]
+    with PROFILER.span("glob_devices", patterns=len(devices or [])):
+        for device_pattern in devices or []:
+            matches = sorted(glob.glob(device_pattern))
+            preconditions.append(("glob", device_pattern, tuple(matches)))
+            for device in matches:
+                logger.debug(f"Find device: {device}")
+                run_options.extend(["--device", device])
+
+    # Handling environment
+    for key, value in (config.runtime.environment or dict()).items():
+        if value is None:
+            run_options.extend(["--env", str(key)])
+        else:
+            run_options.extend(["--env", f"{key}={value}"])
+
+    # Handling other attributes
+    if config.runtime.attributes.use_gpus:
+        run_options.extend(["--gpus", "all"])
+    if config.runtime.attributes.use_privileged:
+        run_options.append("--privileged")
+    if config.runtime.attributes.use_user_permission:
+        run_options.extend(["-u", f"{os.geteuid()}:{os.getegid()}"])
+    if config.runtime.attributes.use_hostname:
+        run_options.extend(["--hostname", socket.gethostname()])
+
+    run_options.extend(config.runtime.extra_args)
+
+    preconditions.append(("image", config.library.name))
+
+    sources = [os.path.abspath("defaults.json"), os.path.abspath(os.path.join(config.path, "config.json")),
+               os.path.abspath(os.path.join(config.path, "Dockerfile")), get_library_manifest_path(config.path)]
+    stamp = {
+        "plan": get_run_plan_path(config.path),
+        "sources": {source: os.stat(source).st_mtime_ns if os.path.exists(source) else None for source in sources},
+        "environment": {name: get_environment_digest(name) for name in sorted(variables)},
+        "user": [os.geteuid(), os.getegid()],
+        "hostname": socket.gethostname()
+    }
+    return RunPlan(
+        library=config.library.name,
+        runtime=config.runtime.name,
+        path=get_absolute_path(config.path),
+        build_options=tuple(build_options),
+        interactive_arguments=tuple(interactive_arguments),
+        run_options=tuple(map(str, run_options)),
+        build_labels=(),
+        run_labels=(),
+        preconditions=tuple(preconditions),
+        stamp=stamp
+    )
+
+
+def is_run_plan_current(plan: RunPlan, prober: MountProber):
+    stamp = plan.stamp
+    for source, mtime in stamp["sources"].items():
+        if (os.stat(source).st_mtime_ns if os.path.exists(source) else None) != mtime:
+            return False
+    for name, digest in stamp["environment"].items():
+        if get_environment_digest(name) != digest:
+            return False
+    if stamp["user"] != [os.geteuid(), os.getegid()] or stamp["hostname"] != socket.gethostname():
+        return False
+
+    sources = [values[0] for kind, *values in plan.preconditions if kind in ("exists", "missing")]
+    probes = prober.probe(sources) if sources else dict()
+    for kind, *values in plan.preconditions:
+        if kind == "exists" and probes[values[0]].path is None:
+            return False
+        if kind == "missing" and probes[values[0]].path is not None:
+            return False
+        if kind == "glob" and tuple(sorted(glob.glob(values[0]))) != values[1]:
+            return False
+    return True
+
+
+@profiled("load_run_plan")
+def load_run_plan(path, prober: MountProber):
+    """Returns the cached plan of the library at ``path``, or ``None`` when there is no current one."""
+    plan_path = get_run_plan_path(path)
+    try:
+        plan = RunPlan.from_json(load_json(plan_path))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return plan if is_run_plan_current(plan, prober) else None
+
+
+def dump_run_plan(plan: RunPlan):
+    dump_json_atomically(plan.stamp["plan"], plan.to_json())
+
+
+BuildStep = collections.namedtuple("BuildStep", ['index', 'total', 'instruction', 'elapsed', 'is_cached'])
+
+
+class BuildProgress(object):
+    """Turns the output of ``docker build`` (classic builder or BuildKit plain progress) into step events.
+
+    Every step is logged when it starts and when it finishes, together with its elapsed time and whether it was
+    served from the cache. Raw output lines only go to the debug log.
+    """
+
+    CLASSIC_STEP = re.compile(r"Step (\d+)/(\d+) ?: (.*)")
+    CLASSIC_CACHED = re.compile(r"\s*---> Using cache")
+    CLASSIC_RUNNING = re.compile(r"\s*---> Running in")
+    BUILDKIT_STEP = re.compile(r"#(\d+) \[(?:[^\]]* )?(\d+)/(\d+)\] (.*)")
+    BUILDKIT_CACHED = re.compile(r"#(\d+) CACHED")
+    BUILDKIT_DONE = re.compile(r"#(\d+) DONE (\d+(?:\.\d+)?)s")
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+        self._start_time = time.time()
+        self._classic_step = None
+        self._buildkit_steps = dict()
+        self._steps = []
+
+    @property
+    def steps(self):
+        return self._steps
+
+    def _begin_step(self, index, total, instruction):
+        self._logger.info(f"Step {index}/{total}: {instruction}")
+        return {"index": int(index), "total": int(total), "instruction": instruction, "start_time": time.time(),
+                "is_cached": False}
+
+    def _finish_step(self, step, elapsed=None):
+        if elapsed is None:
+            elapsed = time.time() - step["start_time"]
+        step = BuildStep(step["index"], step["total"], step["instruction"], elapsed, step["is_cached"])
+        self._steps.append(step)
+        self._logger.info(f"Step {step.index}/{step.total} is done in {step.elapsed:.2f}s "
+                          f"({'cache hit' if step.is_cached else 'cache miss'})")
+
+    def feed(self, line):
+        self._logger.debug(f"| {line}")
+
+        matched = self.CLASSIC_STEP.match(line)
+        if matched:
+            if self._classic_step is not None:
+                self._finish_step(self._classic_step)
+            self._classic_step = self._begin_step(*matched.groups())
+            return
+        if self._classic_step is not None:
+            if self.CLASSIC_CACHED.match(line):
+                self._classic_step["is_cached"] = True
+            elif self.CLASSIC_RUNNING.match(line):
+                self._classic_step["is_cached"] = False
+            return
+
+        matched = self.BUILDKIT_STEP.match(line)
+        if matched:
+            vertex, index, total, instruction = matched.groups()
+            if vertex not in self._buildkit_steps:
+                self._buildkit_steps[vertex] = self._begin_step(index, total, instruction)
+            return
+        matched = self.BUILDKIT_CACHED.match(line)
+        if matched and matched.group(1) in self._buildkit_steps:
+            self._buildkit_steps[matched.group(1)]["is_cached"] = True
+            self._finish_step(self._buildkit_steps.pop(matched.group(1)), elapsed=0.0)
+            return
+        matched = self.BUILDKIT_DONE.match(line)
+        if matched and matched.group(1) in self._buildkit_steps:
+            self._finish_step(self._buildkit_steps.pop(matched.group(1)), elapsed=float(matched.group(2)))
+
+    def close(self):
+        if self._classic_step is not None:
+            self._finish_step(self._classic_step)
+            self._classic_step = None
+        if self._steps:
+            cached_steps = sum(step.is_cached for step in self._steps)
+            self._logger.info(f"Built {len(self._steps)} steps ({cached_steps} from cache) "
+                              f"in {time.time() - self._start_time:.2f}s")
+
+
+class ZstdProcessFile(object):
+    """Binary file-like end of a ``zstd`` process, which either compresses what is written to it into a file (``w``)
+    or decompresses a file into what is read from it (``r``)."""
+
+    def __init__(self, command, mode):
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE if mode == "w" else subprocess.DEVNULL,
+                                         stdout=subprocess.PIPE if mode == "r" else subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE)
+        self._file = self._process.stdin if mode == "w" else self._process.stdout
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        stderr = self._process.stderr.read().decode('utf-8', errors='replace')
+        self._process.stderr.close()
+        if self._process.wait() != 0:
+            raise RuntimeError(f"Zstd has failed with return code {self._process.returncode}:\n"
+                               f"{row_pad_prefix(stderr, '... ')}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # The stream is abandoned half-way, so the process is not waited for its output
+        self._process.kill()
+        self._file.close()
+        self._process.stderr.close()
+        self._process.wait()
+
+
+def open_zstd(path, mode="r"):
+    """Opens a zstd-compressed file as a binary stream for reading (``r``) or writing (``w``), with the ``zstandard``
+    package if it is installed or with the ``zstd`` executable otherwise."""
+    if zstandard is not None:
+        if mode == "w":
+            compressor = zstandard.ZstdCompressor(level=LAYER_STORE_COMPRESSION_LEVEL, threads=-1)
+            return compressor.stream_writer(open(path, "wb"), closefd=True)
+        # Tar writers expect every read to be complete, which a buffered reader ensures
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                 LAYER_STORE_CHUNK_SIZE)
+
+    executable = shutil.which("zstd")
+    if executable is None:
+        raise RuntimeError("Layer stores require either the zstandard package or the zstd executable")
+    if mode == "w":
+        return ZstdProcessFile([executable, "-q", "-f", "-T0", f"-{LAYER_STORE_COMPRESSION_LEVEL}", "-o", path], mode)
+    return ZstdProcessFile([executable, "-q", "-d", "-c", path], mode)
+
+
+class LayerStore(object):
+    """Content-addressed store of the image archives (``docker save``) of libraries, meant to be shared by hosts.
+
+    Every file of an archive, which is mostly a layer, is compressed with zstd and kept once under ``blobs`` however
+    many libraries contain it. Small files are kept in the manifest of their library under ``libraries`` instead,
+    which also lists the files of the archive in order. Archives are stored and written again as streams, so an
+    archive is never staged on disk.
+    """
+
+    ArchiveStatistics = collections.namedtuple("ArchiveStatistics", ['size', 'new_size', 'stored_size'])
+    Usage = collections.namedtuple("Usage", ['libraries', 'size', 'content_size', 'stored_size'])
+
+    def __init__(self, path):
+        self._path = get_absolute_path(path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def get_blob_path(self, digest):
+        algorithm, value = digest.split(':', 1)
+        return os.path.join(self._path, "blobs", algorithm, f"{value}.zst")
+
+    def has_blob(self, digest):
+        return os.path.isfile(self.get_blob_path(digest))
+
+    def get_manifest_path(self, library):
+        file_name = urllib.parse.quote(get_image_reference(library), safe='')
+        return os.path.join(self._path, "libraries", f"{file_name}.json")
+
+    def load_manifest(self, library):
+        path = self.get_manifest_path(library)
+        return load_json(path) if os.path.isfile(path) else None
+
+    def iter_manifests(self):
+        for path in sorted(glob.glob(os.path.join(self._path, "libraries", "*.json"))):
+            yield load_json(path)
+
+    def is_complete(self, manifest):
+        return all(self.has_blob(file["digest"]) for file in manifest["files"] if "digest" in file)
+
+    def get_known_layers(self, layers):
+        """Returns the given layers which are stored already by their sizes, except for sizes shared by several."""
+        layers, sizes = set(layers), dict()
+        for manifest in self.iter_manifests():
+            for file in manifest["files"]:
+                if file.get("digest") in layers and self.has_blob(file["digest"]):
+                    sizes.setdefault(file["size"], set()).add(file["digest"])
+        return {size: digests.pop() for size, digests in sizes.items() if len(digests) == 1}
+
+    def add_blob(self, reader, use_hash_only=False):
+        """Stores the content of a binary stream unless it is stored already, and returns its digest and the number of
+        bytes written to the store. With ``use_hash_only``, the content is only hashed."""
+        hasher = hashlib.sha256()
+        if use_hash_only:
+            for chunk in iter(functools.partial(reader.read, LAYER_STORE_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+            return f"sha256:{hasher.hexdigest()}", 0
+
+        mkdir(os.path.join(self._path, "blobs", "sha256"))
+        temporary_path = os.path.join(self._path, "blobs", "sha256", f".{os.getpid()}.{threading.get_ident()}.zst")
+        try:
+            with open_zstd(temporary_path, "w") as writer:
+                for chunk in iter(functools.partial(reader.read, LAYER_STORE_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    writer.write(chunk)
+            digest = f"sha256:{hasher.hexdigest()}"
+            if self.has_blob(digest):
+                return digest, 0
+            stored_size = os.path.getsize(temporary_path)
+            os.replace(temporary_path, self.get_blob_path(digest))
+            return digest, stored_size
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def open_file(self, file):
+        if "content" in file:
+            return io.BytesIO(base64.b64decode(file["content"]))
+        return open_zstd(self.get_blob_path(file["digest"]), "r")
+
+    def add_archive(self, library, image, layers, reader, known_layers=None, inputs=None):
+        """Stores the image archive of a library read from a binary stream, and returns the size of its files, of the
+        ones which are new to the store and of what is written for them.
+
+        Files with the sizes of ``known_layers`` (see ``get_known_layers``) are only hashed. If any of them turns out
+        to be another file, the archive is not stored and None is returned. ``inputs`` are the fingerprint inputs the
+        image is built from (if known), which importing hosts record as their own.
+        """
+        files, size, new_size, stored_size, is_mismatched = [], 0, 0, 0, False
+        with tarfile.open(fileobj=reader, mode="r|") as archive:
+            for member in archive:
+                file = {"name": member.name, "mode": member.mode, "mtime": member.mtime}
+                if member.isdir():
+                    file["type"] = "directory"
+                elif member.issym() or member.islnk():
+                    file.update(type="symlink" if member.issym() else "link", target=member.linkname)
+                elif member.isfile():
+                    file.update(type="file", size=member.size)
+                    size += member.size
+                    # Blobs of archives in the OCI layout are named after their digests
+                    matched = re.fullmatch(r"blobs/(\w+)/([0-9a-f]+)", member.name)
+                    if member.size < LAYER_STORE_INLINE_SIZE:
+                        file["content"] = base64.b64encode(archive.extractfile(member).read()).decode('ascii')
+                    elif matched is not None and self.has_blob(f"{matched.group(1)}:{matched.group(2)}"):
+                        file["digest"] = f"{matched.group(1)}:{matched.group(2)}"
+                    else:
+                        known_layer = (known_layers or dict()).get(member.size)
+                        file["digest"], written_size = self.add_blob(archive.extractfile(member),
+                                                                     use_hash_only=known_layer is not None)
+                        is_mismatched = is_mismatched or known_layer not in (None, file["digest"])
+                        new_size += member.size if written_size else 0
+                        stored_size += written_size
+                else:
+                    continue
+                files.append(file)
+        if is_mismatched:
+            return None
+
+        # The layers of the archive's manifest may be links to the files of the OCI layout
+        entries = {file["name"]: file for file in files}
+        with self.open_file(entries["manifest.json"]) as reader:
+            paths = loads_json(reader.read().decode('utf-8'))[0]["Layers"]
+        for index, path in enumerate(paths):
+            while entries.get(path, dict()).get("type") == "symlink":
+                path = os.path.normpath(os.path.join(os.path.dirname(path), entries[path]["target"]))
+            paths[index] = path
+
+        mkdir(os.path.join(self._path, "libraries"))
+        dump_json_atomically(self.get_manifest_path(library), {
+            "library": library,
+            "image": image,
+            "inputs": inputs,
+            "exported": time.time(),
+            "size": size,
+            "layers": [{"file": path, "digest": layer} for path, layer in zip(paths, layers)],
+            "files": files
+        })
+        return self.ArchiveStatistics(size, new_size, stored_size)
+
+    def write_archive(self, manifest, writer, skipped_files=()):
+        """Writes the image archive of a library to a binary stream, leaving out ``skipped_files``."""
+        with tarfile.open(fileobj=writer, mode="w|", copybufsize=LAYER_STORE_CHUNK_SIZE) as archive:
+            for file in manifest["files"]:
+                if file["name"] in skipped_files:
+                    continue
+                info = tarfile.TarInfo(file["name"])
+                info.mode, info.mtime = file["mode"], file["mtime"]
+                if file["type"] == "file":
+                    info.size = file["size"]
+                    with self.open_file(file) as reader:
+                        archive.addfile(info, reader)
+                    continue
+                if file["type"] == "directory":
+                    info.type = tarfile.DIRTYPE
+                else:
+                    info.type = tarfile.SYMTYPE if file["type"] == "symlink" else tarfile.LNKTYPE
+                    info.linkname = file["target"]
+                archive.addfile(info)
+
+    @staticmethod
+    def get_archive_size(manifest, skipped_files=()):
+        return sum(file.get("size", 0) for file in manifest["files"] if file["name"] not in skipped_files)
+
+    def get_usage(self):
+        """Returns the number of libraries in the store, the size of their archives, the size of their distinct
+        contents and the size taken by the store on disk."""
+        libraries, size, contents, stored_size = 0, 0, dict(), 0
+        for manifest in self.iter_manifests():
+            libraries += 1
+            size += manifest["size"]
+            for file in manifest["files"]:
+                key = file["digest"] if "digest" in file else (manifest["library"], file["name"])
+                contents[key] = file.get("size", 0)
+        for root, _, names in os.walk(self._path):
+            stored_size += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+        return self.Usage(libraries, size, sum(contents.values()), stored_size)
+
+
+class DockerState(object):
+    """Snapshot of the daemon's images and containers, indexed by image reference and container name.
+
+    Lookups query the daemon with server-side filters on their first use (or come from a full listing after
+    ``refresh``) and are then answered from the indexes. Entries are invalidated by curator's own mutating calls, so a
+    snapshot is meant to live for a single action, unless the events of the daemon are applied to it as well. The
+    entries invalidated by curator's own calls are kept as changes, which can be applied to another snapshot.
+    """
+
+    def __init__(self, docker: 'Docker'):
+        self._docker = docker
+        self._lock = threading.RLock()
+        self._images = dict()
+        self._image_details = dict()
+        self._containers = dict()
+        self._is_complete = False
+        self._changed_images = set()
+        self._changed_containers = set()
+
+    @property
+    def lock(self):
+        return self._lock
+
+    @synchronized_member_fn
+    def copy(self, docker: 'Docker') -> 'DockerState':
+        state = DockerState(docker)
+        state._images = dict(self._images)
+        state._image_details = dict(self._image_details)
+        state._containers = dict(self._containers)
+        state._is_complete = self._is_complete
+        return state
+
+    @synchronized_member_fn
+    @profiled("list_state")
+    def refresh(self):
+        # A failed listing raises and leaves the state incomplete, instead of passing for an empty host
+        self._is_complete = False
+        images = {image.reference: image for image in self._docker.list_images()}
+        containers = {container.name: container for container in self._docker.list_containers()}
+        self._images, self._containers = images, containers
+        self._image_details.clear()
+        self._is_complete = True
+
+    @profiled("query_image")
+    def _query_image(self, reference):
+        images = self._docker.list_images(reference=reference)
+        self._images[reference] = next((image for image in images if image.reference == reference), None)
+
+    @profiled("query_container")
+    def _query_container(self, name):
+        containers = self._docker.list_containers(name=name)
+        self._containers[name] = next((container for container in containers if container.name == name), None)
+
+    @synchronized_member_fn
+    def get_image(self, name) -> ImageInfo:
+        reference = get_image_reference(name)
+        if reference not in self._images:
+            if self._is_complete:
+                return None
+            self._query_image(reference)
+        return self._images[reference]
+
+    @synchronized_member_fn
+    def get_image_details(self, name) -> dict:
+        reference = get_image_reference(name)
+        if reference not in self._image_details:
+            self._image_details[reference] = self._docker.inspect_image(name)
+        return self._image_details[reference]
+
+    @synchronized_member_fn
+    def list_images(self):
+        if not self._is_complete:
+            self.refresh()
+        return [image for image in self._images.values() if image is not None]
+
+    @synchronized_member_fn
+    def list_containers(self):
+        if not self._is_complete:
+            self.refresh()
+        return [container for container in self._containers.values() if container is not None]
+
+    @synchronized_member_fn
+    def get_container(self, name) -> ContainerInfo:
+        if name not in self._containers:
+            if self._is_complete:
+                return None
+            self._query_container(name)
+        return self._containers[name]
+
+    @synchronized_member_fn
+    def invalidate_image(self, name):
+        self._changed_images.add(get_image_reference(name))
+        self._invalidate_image(name)
+
+    @synchronized_member_fn
+    def invalidate_container(self, name):
+        self._changed_containers.add(name)
+        self._invalidate_container(name)
+
+    @synchronized_member_fn
+    def invalidate_all(self):
+        """Drops every entry, so that they are queried again on their next use until the state is refreshed."""
+        self._images.clear()
+        self._image_details.clear()
+        self._containers.clear()
+        self._is_complete = False
+
+    def _invalidate_image(self, name):
+        reference = get_image_reference(name)
+        self._images.pop(reference, None)
+        self._image_details.pop(reference, None)
+        if self._is_complete:
+            self._query_image(reference)
+
+    def _invalidate_container(self, name):
+        self._containers.pop(name, None)
+        if self._is_complete:
+            self._query_container(name)
+
+    @synchronized_member_fn
+    def get_changes(self):
+        """Returns the images and the containers invalidated by curator's own calls."""
+        return {"images": sorted(self._changed_images), "containers": sorted(self._changed_containers)}
+
+    @synchronized_member_fn
+    def apply_changes(self, changes):
+        """Invalidates the entries changed by the calls of another state, as returned by its ``get_changes``."""
+        for name in changes["images"]:
+            self._invalidate_image(name)
+        for name in changes["containers"]:
+            self._invalidate_container(name)
+
+    @synchronized_member_fn
+    def apply_event(self, event):
+        """Invalidates the entries changed by an event of ``docker events``."""
+        actor, action = event.get("Actor", {}), event.get("Action")
+        attributes = actor.get("Attributes", {})
+        if event.get("Type") == "container" and action == "destroy" and "name" in attributes:
+            self._containers[attributes["name"]] = None
+        elif event.get("Type") == "container" and action in DAEMON_CONTAINER_ACTIONS and action != "rename" and \
+                "name" in attributes:
+            self._invalidate_container(attributes["name"])
+        elif event.get("Type") == "container" and action == "rename":
+            # The previous name of a renamed container is not reported, so all of them are listed again
+            self._containers.clear()
+            if self._is_complete:
+                self._containers.update((container.name, container) for container in self._docker.list_containers())
+        elif event.get("Type") == "image" and action in DAEMON_IMAGE_ACTIONS:
+            # Image events carry an ID, a reference or both, and an ID stands for the references of its image
+            references = set()
+            for value in (actor.get("ID"), attributes.get("name")):
+                if value and value.startswith("sha256:"):
+                    references.update(reference for reference, image in self._images.items()
+                                      if image is not None and image.id == value)
+                elif value:
+                    references.add(get_image_reference(value))
+            for reference in references:
+                self._invalidate_image(reference)
+
+
+class Docker(object, metaclass=abc.ABCMeta):
+    DockerResult = collections.namedtuple("DockerResult", ['stdout', 'stderr', 'return_code'])
+
+    def __init__(self, logger: logging.Logger, environ=None):
+        self._logger = logger
+        # Environment of the docker processes spawned by the backend, or None for the one of this process
+        self._environ = environ
+        self._state = DockerState(self)
+
+    @property
+    def logger(self):
+        return self._logger
+
+    @property
+    def state(self):
+        return self._state
+
+    @abc.abstractmethod
+    def get_version(self):
+        pass
+
+    @abc.abstractmethod
+    def list_images(self, reference=None):
+        pass
+
+    @abc.abstractmethod
+    def list_containers(self, name=None):
+        pass
+
+    @abc.abstractmethod
+    def inspect_image(self, name):
+        pass
+
+    @abc.abstractmethod
+    def _build_image(self, name, path, build_args, labels=None, use_no_cache=False, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _pull_image(self, name, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _run_container(self, name, image, args, labels=None, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _start_container(self, name, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _stop_container(self, name, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _remove_container(self, name, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def _remove_image(self, name, use_dry_run=False):
+        pass
+
+    @abc.abstractmethod
+    def get_disk_usage(self):
+        """Returns the bytes taken by the images and the containers of the daemon."""
+        pass
+
+    @abc.abstractmethod
+    def list_image_sizes(self):
+        pass
+
+    @abc.abstractmethod
+    def list_container_sizes(self):
+        """Returns the sizes of the writable layers of the containers created by curator."""
+        pass
+
+    @abc.abstractmethod
+    def save_image(self, name, read_archive):
+        """Streams the image archive of ``docker save`` to ``read_archive`` (called with a binary stream), and returns
+        what it returns."""
+        pass
+
+    @abc.abstractmethod
+    def _load_image(self, write_archive, use_ignored_errors=False):
+        """Streams the image archive written by ``write_archive`` (called with a binary stream) to ``docker load``."""
+        pass
+
+    @abc.abstractmethod
+    def exec_container(self, name, command):
+        pass
+
+    @abc.abstractmethod
+    def iter_events(self, since=None):
+        """Yields the image and container events of the daemon (since a unix timestamp) as they happen."""
+        pass
+
+    @abc.abstractmethod
+    def _clone(self, logger: logging.Logger, environ):
+        pass
+
+    def clone(self, logger: logging.Logger, environ=None):
+        """Returns a backend for the same daemon with its own connection, starting from a copy of the state. The
+        docker processes of the backend are spawned with ``environ`` if it is given, or with the same environment."""
+        docker = self._clone(logger, environ if environ is not None else self._environ)
+        docker._state = self._state.copy(docker)
+        return docker
+
+    def _report_error(self, stringified_command, return_code, output):
+        """Logs a failed docker command with the latest ``FAILURE_REPORT_LINES`` lines of its output (if it is not
+        printed to the terminal), and raises a ``RuntimeError``."""
+        lines = (output or '').splitlines()[-FAILURE_REPORT_LINES:]
+        report = f"Output (last {len(lines)} lines):\n{row_pad_prefix(lines, '... ')}\n" if lines else ''
+        self._logger.critical(f"An error has occurred when executing docker command.\n"
+                              f"Command: {stringified_command}\n"
+                              f"Return code: {return_code}\n"
+                              f"{report}")
+        raise RuntimeError("An error has occurred when executing docker command.")
+
+    def build_image(self, name, path, build_args, labels=None, use_no_cache=False, use_dry_run=False):
+        result = self._build_image(name, path, build_args, labels=labels, use_no_cache=use_no_cache,
+                                   use_dry_run=use_dry_run)
+        self._state.invalidate_image(name)
+        return result
+
+    def pull_image(self, name, use_dry_run=False):
+        result = self._pull_image(name, use_dry_run=use_dry_run)
+        self._state.invalidate_image(name)
+        return result
+
+    def run_container(self, name, image, args, labels=None, use_dry_run=False):
+        result = self._run_container(name, image, args, labels=labels, use_dry_run=use_dry_run)
+        self._state.invalidate_container(name)
+        return result
+
+    def start_container(self, name, use_dry_run=False):
+        result = self._start_container(name, use_dry_run=use_dry_run)
+        self._state.invalidate_container(name)
+        return result
+
+    def stop_container(self, name, use_dry_run=False):
+        result = self._stop_container(name, use_dry_run=use_dry_run)
+        self._state.invalidate_container(name)
+        return result
+
+    def remove_container(self, name, use_dry_run=False):
+        result = self._remove_container(name, use_dry_run=use_dry_run)
+        self._state.invalidate_container(name)
+        return result
+
+    def remove_image(self, name, use_dry_run=False):
+        result = self._remove_image(name, use_dry_run=use_dry_run)
+        self._state.invalidate_image(name)
+        return result
+
+    def load_image(self, name, write_archive, use_ignored_errors=False):
+        result = self._load_image(write_archive, use_ignored_errors=use_ignored_errors)
+        self._state.invalidate_image(name)
+        return result
+
+    def is_built(self, config):
+        return self._state.get_image(config.library.name) is not None
+
+    def get_runtime_status(self, config):
+        """Returns the status of the container named after the runtime, which is the one ``start`` replaces and
+        ``clean`` removes. Docker shows the image of a container by its ID once its tag is moved to a rebuilt image,
+        so a container is told apart by its run fingerprint label rather than by its image.
+        """
+        container = self._state.get_container(config.runtime.name)
+        if container is None:
+            return None
+        if not container.fingerprint and container.image != config.library.name:
+            self._logger.warning(f"Find container named \"{config.runtime.name}\" "
+                                 f"which is not built with library \"{config.library.name}\"")
+        return container.status
+
+    def get_image_variables(self, name):
+        result = dict()
+        info = self._state.get_image_details(name)
+        for environ in info['Config']['Env']:
+            key, *value = environ.split('=')
+            result.setdefault(key, '='.join(value))
+        return result
+
+    @profiled("get_library_variables")
+    def get_library_variables(self, config):
+        manifest = load_library_manifest(config.path)
+        if manifest is not None and "variables" in manifest:
+            return manifest["variables"]
+        if not self.is_built(config):
+            raise RuntimeError(f"Library \"{config.library.name}\" has to be built before resolving its mounts")
+        return self.get_image_variables(config.library.name)
+
+    @profiled("get_library_inputs")
+    def get_library_inputs(self, config, manifest=None):
+        """Collects the digests of everything a library's image is built from.
+
+        Arguments prompted interactively are left out, so that checking a library never asks for them. Base images
+        which are not present locally keep the digests recorded in ``manifest``.
+        """
+        return collect_library_inputs(config.path, get_build_arguments(config, use_prompt=False),
+                                      self.get_base_digests(config.path, manifest))
+
+    def get_base_digests(self, path, manifest=None):
+        bases = dict()
+        recorded_bases = manifest["inputs"]["bases"] if manifest is not None else dict()
+        for base in get_library_bases(path):
+            image = self._state.get_image(base)
+            bases[base] = image.id if image is not None else recorded_bases.get(base)
+        return bases
+
+    def get_build_changes(self, config):
+        """Returns the reasons why a library has to be built, which are empty when its image is up-to-date."""
+        image = self._state.get_image(config.library.name)
+        if image is None:
+            return [f"image \"{config.library.name}\" does not exist"]
+
+        manifest = load_library_manifest(config.path)
+        inputs = self.get_library_inputs(config, manifest)
+        fingerprint = get_fingerprint(inputs)
+        if manifest is not None and manifest["image"] == image.id:
+            return [] if manifest["fingerprint"] == fingerprint else get_input_changes(manifest["inputs"], inputs)
+
+        # The image is not the one recorded locally, but it may still carry a matching fingerprint
+        labels = self._state.get_image_details(config.library.name)['Config'].get('Labels') or dict()
+        if labels.get(FINGERPRINT_LABEL) == fingerprint:
+            self._dump_library_manifest(config, image, inputs)
+            return []
+        return [f"image \"{config.library.name}\" is not built from the current inputs"]
+
+    def _dump_library_manifest(self, config, image, inputs):
+        dump_json_atomically(get_library_manifest_path(config.path), {
+            "library": config.library.name,
+            "path": get_absolute_path(config.path, use_real_path=True),
+            "image": image.id,
+            "fingerprint": get_fingerprint(inputs),
+            "inputs": inputs,
+            "variables": self.get_image_variables(config.library.name)
+        })
+
+    @profiled("build")
+    def build(self, config):
+        use_force = getattr(config, "force", False)
+        if not use_force:
+            changes = self.get_build_changes(config)
+            if not changes:
+                self._logger.info(f"Library \"{config.library.name}\" is up-to-date")
+                return
+            if getattr(config, "why", False):
+                self._logger.info(f"Library \"{config.library.name}\" will be built because:\n"
+                                  f"{row_pad_prefix(changes, '... ')}")
+
+        args = get_build_arguments(config)
+        # Missing bases are pulled before the build instead of by it, so that the label fingerprints their IDs as the
+        # manifest does
+        for base in get_library_bases(config.path):
+            if self._state.get_image(base) is None:
+                self.pull_image(base, use_dry_run=config.dry_run)
+        inputs = self.get_library_inputs(config)
+        self.build_image(config.library.name, config.path, args, labels={FINGERPRINT_LABEL: get_fingerprint(inputs)},
+                         use_no_cache=use_force, use_dry_run=config.dry_run)
+        if config.dry_run:
+            return
+
+        self._dump_library_manifest(config, self._state.get_image(config.library.name), inputs)
+        self._record_usage(config, "built")
+
+    def _record_usage(self, config, event):
+        """Records when a library is built, started or attached on this host, for ``collect_garbage``."""
+        if getattr(config, "dry_run", False):
+            return
+        path = get_library_usage_path(config.library.name)
+        try:
+            record = load_json(path)
+        except (OSError, ValueError):
+            record = dict()
+        record.update(library=get_image_reference(config.library.name), host=socket.gethostname(),
+                      path=get_absolute_path(config.path, use_real_path=True), runtime=config.runtime.name,
+                      bases=get_library_bases(config.path))
+        record[event] = time.time()
+        if event == "built":
+            record.update(image=self._state.get_image(config.library.name).id,
+                          size=self._state.get_image_details(config.library.name).get('Size'))
+        dump_json_atomically(path, record)
+
+    def get_resolved_run_plan(self, config):
+        """Returns the cached plan of a library, or resolves it, without its labels."""
+        prober = MountProber(self._logger)
+        plan = load_run_plan(config.path, prober)
+        if plan is None:
+            plan = resolve_run_plan(config, functools.partial(self.get_library_variables, config), self._logger,
+                                    prober)
+            dump_run_plan(plan)
+        return plan
+
+    def get_run_plan(self, config):
+        """Returns the plan of a library, labeled from the images on the daemon."""
+        plan = self.get_resolved_run_plan(config)
+        image = self._state.get_image(config.library.name)
+        return label_run_plan(plan, self.get_base_digests(config.path), image.id if image is not None else None)
+
+    @profiled("start")
+    def start(self, config):
+        self.build(config)
+        plan = self.get_run_plan(config)
+        fingerprint = dict(plan.run_labels)[RUN_FINGERPRINT_LABEL]
+
+        # A container created from the same image and options is kept, along with its writable layer
+        container = self._state.get_container(plan.runtime)
+        if container is not None and container.fingerprint == fingerprint and not getattr(config, "recreate", False):
+            if container.status.startswith("Up"):
+                self._logger.info(f"Container \"{plan.runtime}\" is up-to-date and running")
+            else:
+                self._logger.info(f"Container \"{plan.runtime}\" is up-to-date, starting it")
+                self.start_container(plan.runtime, use_dry_run=config.dry_run)
+            self._record_usage(config, "started")
+            return
+
+        if container is not None:
+            reason = "as requested" if getattr(config, "recreate", False) else "since its image or options are changed"
+            self._logger.info(f"Recreating container \"{plan.runtime}\" {reason}")
+            self.clean(config)
+
+        self.run_container(plan.runtime, plan.library, plan.run_options, labels=dict(plan.run_labels),
+                           use_dry_run=config.dry_run)
+        self._record_usage(config, "started")
+
+    @profiled("clean")
+    def clean(self, config):
+        runtime_status = self.get_runtime_status(config)
+        if runtime_status is not None:
+            if runtime_status.startswith("Up"):
+                self.stop_container(config.runtime.name, use_dry_run=config.dry_run)
+            self.remove_container(config.runtime.name, use_dry_run=config.dry_run)
+
+        if getattr(config, "with_images", False) and self.is_built(config):
+            self.remove_image(config.library.name, use_dry_run=config.dry_run)
+
+    @profiled("attach")
+    def attach(self, config):
+        if not self.is_built(config):
+            self.build(config)
 
+        runtime_status = self.get_runtime_status(config)
+        if runtime_status is None or not runtime_status.startswith("Up"):
+            self.start(config)
 
-class DockerCLI(object):
-    DockerResult = collections.namedtuple("DockerResult", ['stdout', 'stderr', 'return_code'])
+        self._record_usage(config, "attached")
+        self.exec_container(config.runtime.name, config.runtime.attach_entrypoint)
 
-    def __init__(self, docker_executable, logger: logging.Logger):
-        self._docker_executable = docker_executable
-        self._logger = logger
+    def get_present_layers(self, config, layers):
+        """Returns how many leading layers of an image exist locally, as the layers of the library's current image or
+        of its bases."""
+        count = 0
+        for name in get_library_bases(config.path) + [config.library.name]:
+            if self._state.get_image(name) is None:
+                continue
+            local_layers = self._state.get_image_details(name)['RootFS']['Layers']
+            common = next((index for index, (layer, local_layer) in enumerate(zip(layers, local_layers))
+                           if layer != local_layer), min(len(layers), len(local_layers)))
+            count = max(count, common)
+        return count
 
-    @classmethod
-    def _expand_with_dict(cls, text: str, data: dict):
-        text = string.Template(text)
-        text = text.substitute(data)
-        return text
+    @profiled("export")
+    def export_library(self, config):
+        name = config.library.name
+        image = self._state.get_image(name)
+        if image is None:
+            raise RuntimeError(f"Library \"{name}\" has to be built before being exported")
+        store = LayerStore(config.store)
+        manifest = store.load_manifest(name)
+        if manifest is not None and manifest["image"] == image.id and "inputs" in manifest and \
+                store.is_complete(manifest):
+            self._logger.info(f"Library \"{name}\" is up-to-date in \"{store.path}\"")
+            return
 
-    @property
-    def logger(self):
-        return self._logger
+        inputs = self.get_image_inputs(config, image)
+        if inputs is None:
+            self._logger.warning(f"The inputs of library \"{name}\" are unknown, so hosts importing it will build it "
+                                 f"again")
+        layers = self._state.get_image_details(name)['RootFS']['Layers']
+        start_time = time.time()
+        statistics = self.save_image(name, functools.partial(store.add_archive, name, image.id, layers,
+                                                             known_layers=store.get_known_layers(layers),
+                                                             inputs=inputs))
+        if statistics is None:
+            self._logger.warning(f"A layer of library \"{name}\" was mistaken for a stored one of the same size, "
+                                 f"exporting it again")
+            statistics = self.save_image(name, functools.partial(store.add_archive, name, image.id, layers,
+                                                                 inputs=inputs))
+        elapsed_time = max(time.time() - start_time, 1e-6)
+        dedup = f"{statistics.size / statistics.new_size:.2f}x" if statistics.new_size else "all"
+        self._logger.info(f"Exported library \"{name}\" to \"{store.path}\": {format_size(statistics.size)} in "
+                          f"{elapsed_time:.1f}s ({format_size(statistics.size / elapsed_time)}/s), "
+                          f"{format_size(statistics.new_size)} of new content stored in "
+                          f"{format_size(statistics.stored_size)} (deduplicated {dedup})")
+
+    def get_image_inputs(self, config, image):
+        """Returns the fingerprint inputs the current image of a library is built from, or None if they are unknown."""
+        manifest = load_library_manifest(config.path)
+        if manifest is None or manifest["image"] != image.id:
+            # Records the inputs if the image carries the fingerprint of the current ones
+            self.get_build_changes(config)
+            manifest = load_library_manifest(config.path)
+        return manifest["inputs"] if manifest is not None and manifest["image"] == image.id else None
+
+    def _record_imported_inputs(self, config, manifest):
+        # The bases are usually absent on the importing host, so their IDs are taken from the exporting one
+        if manifest.get("inputs") is None:
+            return
+        local_manifest = load_library_manifest(config.path)
+        if local_manifest is None or local_manifest["image"] != manifest["image"]:
+            self._dump_library_manifest(config, self._state.get_image(config.library.name), manifest["inputs"])
+
+    @profiled("import")
+    def import_library(self, config):
+        name = config.library.name
+        store = LayerStore(config.store)
+        manifest = store.load_manifest(name)
+        if manifest is None:
+            raise RuntimeError(f"Library \"{name}\" is not exported to \"{store.path}\"")
+        image = self._state.get_image(name)
+        if image is not None and image.id == manifest["image"]:
+            self._record_imported_inputs(config, manifest)
+            self._logger.info(f"Library \"{name}\" is up-to-date")
+            return
+
+        # Docker does not read the layers it has already, so they are left out of the archive
+        present = self.get_present_layers(config, [layer["digest"] for layer in manifest["layers"]])
+        skipped_files = {layer["file"] for layer in manifest["layers"][:present]} - \
+            {layer["file"] for layer in manifest["layers"][present:]}
+        start_time = time.time()
+        result = self.load_image(name, functools.partial(store.write_archive, manifest, skipped_files=skipped_files),
+                                 use_ignored_errors=bool(skipped_files))
+        if result.return_code != 0:
+            self._logger.warning(f"Docker cannot load library \"{name}\" without the {present} layers it has "
+                                 f"({(result.stderr or '').strip()}), importing it with all layers")
+            present, skipped_files = 0, set()
+            self.load_image(name, functools.partial(store.write_archive, manifest))
+        elapsed_time = max(time.time() - start_time, 1e-6)
+        self._record_imported_inputs(config, manifest)
+        self._record_usage(config, "built")
+        size = store.get_archive_size(manifest, skipped_files)
+        self._logger.info(f"Imported library \"{name}\" from \"{store.path}\": {present} of "
+                          f"{len(manifest['layers'])} layers exist already, {format_size(size)} streamed in "
+                          f"{elapsed_time:.1f}s ({format_size(size / elapsed_time)}/s)")
+
+    @profiled("gc")
+    def collect_garbage(self, config):
+        """Removes the least recently used libraries of this host, namely their stopped containers and their images,
+        until the images and containers of docker take at most ``config.max_disk`` bytes.
+
+        Only libraries recorded by curator on this host are removed. A library is kept while it is the ``FROM`` base of
+        a kept library, or while a running container or a container other than its runtime uses its image.
+        """
+        usage = self.get_disk_usage()
+        if usage <= config.max_disk:
+            self._logger.info(f"Images and containers take {format_size(usage)}, within {format_size(config.max_disk)}")
+            return
 
-    @cached_property
-    def version(self):
+        images = {image.reference: image for image in self._state.list_images()}
+        containers = self._state.list_containers()
+        image_sizes, container_sizes = self.list_image_sizes(), self.list_container_sizes()
+        records = {reference: record for reference, record in load_library_usages().items() if reference in images}
+
+        def get_last_used(reference):
+            return max(records[reference].get(event) or 0.0 for event in ("built", "started", "attached"))
+
+        def get_users(reference):
+            return [container for container in containers if get_image_reference(container.image) == reference]
+
+        def get_blocker(reference):
+            for other in sorted(kept - {reference}):
+                if reference in map(get_image_reference, records[other]["bases"]):
+                    return f"base of {other}"
+            for container in get_users(reference):
+                if container.status.startswith("Up") or container.name != records[reference]["runtime"]:
+                    return f"used by container {container.name}"
+            return None
+
+        def get_freed_size(reference):
+            # An image with other tags is only untagged, and the layers of its bases are shared
+            if any(image.id == images[reference].id for image in images.values() if image.reference != reference):
+                size = 0
+            else:
+                bases = [get_image_reference(base) for base in records[reference]["bases"]]
+                base_size = max((image_sizes.get(base, 0) for base in bases if base in images), default=0)
+                size = image_sizes.get(reference, 0) - base_size
+            return max(size, 0) + sum(container_sizes.get(container.name, 0) for container in get_users(reference))
+
+        kept, evictions = set(records), dict()
+        while usage - sum(evictions.values()) > config.max_disk:
+            candidates = [reference for reference in kept if get_blocker(reference) is None]
+            if not candidates:
+                break
+            reference = min(candidates, key=get_last_used)
+            kept.remove(reference)
+            evictions[reference] = get_freed_size(reference)
+
+        table = dict()
+        for reference in sorted(records, key=get_last_used):
+            if reference in evictions:
+                status = f"remove  about {format_size(evictions[reference])}"
+            else:
+                status = f"keep    ({get_blocker(reference) or 'within budget'})"
+            table[reference] = f"last used {format_time(get_last_used(reference))}  {status}"
+        freed = sum(evictions.values())
+        self._logger.info(f"Images and containers take {format_size(usage)}, over {format_size(config.max_disk)}. "
+                          f"{'Would free' if config.dry_run else 'Freeing'} about {format_size(freed)} by removing "
+                          f"{len(evictions)} least recently used libraries:\n"
+                          f"{dumps_table(table, indent=4) if table else '    (no library is recorded)'}")
+        if usage - freed > config.max_disk:
+            self._logger.warning(f"Removing the unused libraries is not enough to be within "
+                                 f"{format_size(config.max_disk)}")
+        if config.dry_run:
+            return
+
+        for reference in evictions:
+            try:
+                for container in get_users(reference):
+                    self.remove_container(container.name)
+                self.remove_image(reference)
+            except RuntimeError:
+                self._logger.warning(f"Unable to remove library \"{reference}\", which is skipped")
+                continue
+            os.remove(get_library_usage_path(reference))
+        self._logger.info(f"Images and containers take {format_size(self.get_disk_usage())} now")
+
+
+class DockerCLI(Docker):
+    def __init__(self, docker_executable, logger: logging.Logger, environ=None):
+        super(DockerCLI, self).__init__(logger, environ=environ)
+        self._docker_executable = docker_executable
+
+    def get_version(self):
         result = self.execute("--version", use_stdout_pipe=True)
         version = re.findall(r"Docker version (\d+\.\d+\.\d+).*", result.stdout)
         if len(version) != 1:
@@ -83,276 +1818,1141 @@ class DockerCLI(object):
 
         if use_dry_run:
             return None
-        pipe = subprocess.Popen(command, stdout=subprocess.PIPE if use_stdout_pipe else None, stderr=subprocess.PIPE)
-
-        stdout, stderr = pipe.communicate()
+        with PROFILER.span(f"docker {args[0]}", "docker", argv=command) as span:
+            pipe = subprocess.Popen(command, stdout=subprocess.PIPE if use_stdout_pipe else None,
+                                    stderr=subprocess.PIPE, env=self._environ)
+            stdout, stderr = pipe.communicate()
+            span.args.update(return_code=pipe.returncode, stdout_bytes=len(stdout or b''),
+                             stderr_bytes=len(stderr or b''))
         if stderr:
             stderr = stderr.decode('utf-8')
         if stdout:
             stdout = stdout.decode('utf-8')
 
         if not use_ignored_errors and pipe.returncode != 0:
-            self._logger.critical(f"An error has occurred when executing docker command.\n"
-                                  f"Command: {stringified_command}\n"
-                                  f"Return code: {pipe.returncode}\n"
-                                  f"Stderr:\n"
-                                  f"{row_pad_prefix(stderr, '... ')}\n")
-            raise RuntimeError("An error has occurred when executing docker command.")
+            self._report_error(stringified_command, pipe.returncode, stderr)
 
         return self.DockerResult(stdout=stdout, stderr=stderr, return_code=pipe.returncode)
 
-    def is_built(self, config):
-        docker_images = self.execute("images", "--format", "{{ .Repository }}:{{ .Tag }}", use_stdout_pipe=True)
-        docker_images = docker_images.stdout.split('\n')
-        return config.library.name in docker_images or f"{config.library.name}:latest" in docker_images
+    def execute_stream(self, *args, use_dry_run=False):
+        """Executes a docker command and yields its (merged) output line by line as it arrives.
 
-    def get_runtime_status(self, config):
+        Only the latest ``FAILURE_REPORT_LINES`` lines are kept for the report logged when the command fails.
+        """
+        command = [self._docker_executable] + list(map(str, args))
+        stringified_command = ' '.join(command)
+        if use_dry_run:
+            self._logger.debug(f"Execute (dry-run): \"{stringified_command}\"")
+            return
+        self._logger.debug(f"Execute: \"{stringified_command}\"")
+
+        tail = collections.deque(maxlen=FAILURE_REPORT_LINES)
+        with PROFILER.span(f"docker {args[0]}", "docker", argv=command) as span, \
+                subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self._environ) as pipe:
+            output_lines = 0
+            for line in io.TextIOWrapper(pipe.stdout, encoding='utf-8', errors='replace'):
+                line = line.rstrip('\n')
+                tail.append(line)
+                output_lines += 1
+                yield line
+            pipe.wait()
+            span.args.update(return_code=pipe.returncode, output_lines=output_lines)
+
+        if pipe.returncode != 0:
+            self._report_error(stringified_command, pipe.returncode, '\n'.join(tail))
+
+    def list_images(self, reference=None):
+        args = ["--filter", f"reference={reference}"] if reference is not None else []
+        docker_images = self.execute(
+            "images", "--no-trunc", *args, "--format", "{{ .Repository }}:{{ .Tag }}|{{ .ID }}",
+            use_stdout_pipe=True
+        )
+        return list(ImageInfo(*info.split('|')) for info in (docker_images.stdout or '').split('\n') if info)
+
+    def list_containers(self, name=None):
+        args = ["--filter", f"name=^/?{re.escape(name)}$"] if name is not None else []
         docker_containers = self.execute(
-            "ps", "-a", "--format", "{{ .Names }}|{{ .Image }}|{{ .Status }}",
+            "ps", "-a", *args, "--format",
+            f"{{{{ .Names }}}}|{{{{ .Image }}}}|{{{{ .Status }}}}|{{{{ .Label \"{RUN_FINGERPRINT_LABEL}\" }}}}",
             use_stdout_pipe=True
         )
-        docker_containers = list(info.split('|') for info in docker_containers.stdout.split('\n'))
-        for container in docker_containers:
-            if container[0] == config.runtime.name:
-                if container[1] == config.library.name:
-                    return container[2]
-                self._logger.warning(f"Find container named \"{config.runtime.name}\" "
-                                     f"which is not built with library \"{config.library.name}\"")
-        return None
+        return list(ContainerInfo(*info.split('|', 3)) for info in (docker_containers.stdout or '').split('\n') if info)
 
-    def get_library_variables(self, config):
-        result = dict()
-        info = loads_json(self.execute("image", "inspect", config.library.name, use_stdout_pipe=True).stdout)
-        for environ in info[0]['Config']['Env']:
-            key, *value = environ.split('=')
-            result.setdefault(key, '='.join(value))
-        return result
+    def inspect_image(self, name):
+        return loads_json(self.execute("image", "inspect", name, use_stdout_pipe=True).stdout)[0]
 
-    def build(self, config):
+    def _build_image(self, name, path, build_args, labels=None, use_no_cache=False, use_dry_run=False):
         args = list()
-        for key, value in config.library.arguments.items():
-            if value is None:
-                value = input(f"Please input the build argument {key}: ")
-            elif value.startswith("$%"):
-                value = value[2:]
-                if value == "EUID":
-                    value = os.geteuid()
-                elif value == "EGID":
-                    value = os.getegid()
-                elif value == "UID":
-                    value = os.getuid()
-                elif value == "GID":
-                    value = os.getgid()
-                else:
-                    raise ValueError(f"Unrecognized builtin variable \"{value}\"")
-            elif value.startswith("$"):
-                value = os.environ[value[1:]]
+        for key, value in build_args.items():
             args.extend(["--build-arg", f"{key}={value}"])
-        if getattr(config, "force", False):
+        for key, value in (labels or dict()).items():
+            args.extend(["--label", f"{key}={value}"])
+        if use_no_cache:
             args.append('--no-cache')
-        self.execute("build", "-t", config.library.name, config.path, *args, use_dry_run=config.dry_run)
 
-    def start(self, config):
-        if not self.is_built(config):
-            self.build(config)
+        progress = BuildProgress(self._logger)
+        for line in self.execute_stream("build", "-t", name, path, *args, use_dry_run=use_dry_run):
+            progress.feed(line)
+        progress.close()
 
-        if self.get_runtime_status(config) is not None:
-            self.clean(config)
+    def _pull_image(self, name, use_dry_run=False):
+        return self.execute("pull", name, use_dry_run=use_dry_run)
 
-        args = []
+    def _run_container(self, name, image, args, labels=None, use_dry_run=False):
+        label_args = [f"--label={key}={value}" for key, value in (labels or dict()).items()]
+        return self.execute("run", "-td", "--name", name, *args, *label_args, image, use_dry_run=use_dry_run)
 
-        # Handling volume mounts
-        if config.runtime.mounts:
-            runtime_variables = self.get_library_variables(config)
-            for name, trials in config.runtime.mounts.items():
-                if trials is None:
-                    if name in config.preset.runtime.mounts:
-                        trials = config.preset.runtime.mounts[name]
-                    else:
-                        self._logger.warning(f"Skipping mount \"{name}\", which is not a preset value")
-                        continue
-
-                is_any_trial_successful = False
-                for trial in trials:
-                    is_trial_failed = False
-                    for option in trial:
-                        option.source = os.path.expanduser(os.path.expandvars(option.source))
-                        option.source = get_absolute_path(option.source, use_real_path=True)
-                        if not os.path.exists(option.source):
-                            is_trial_failed = True
-                            break
-
-                    if not is_trial_failed:
-                        is_any_trial_successful = True
-                        for option in trial:
-                            option.target = self._expand_with_dict(option.target, runtime_variables)
-
-                            args.extend(["-v", f"{option.source}:{option.target}:{option.mode}"])
-                        break
-
-                if not is_any_trial_successful:
-                    self._logger.warning(f"All trials on mounting collection \"{name}\" are failed")
-
-        # Handling network mappings
-        if config.runtime.networks == "host":
-            args.extend(["--net", "host"])
-        else:
-            if isinstance(config.runtime.networks, str):
-                config.runtime.networks = config.preset.runtime.networks[config.runtime.networks]
+    def _start_container(self, name, use_dry_run=False):
+        return self.execute("start", name, use_dry_run=use_dry_run)
+
+    def _stop_container(self, name, use_dry_run=False):
+        return self.execute("stop", name, use_dry_run=use_dry_run)
+
+    def _remove_container(self, name, use_dry_run=False):
+        return self.execute("rm", name, use_dry_run=use_dry_run)
+
+    def _remove_image(self, name, use_dry_run=False):
+        return self.execute("rmi", name, use_dry_run=use_dry_run)
+
+    def exec_container(self, name, command):
+        return self.execute("exec", "-it", name, command)
+
+    def get_disk_usage(self):
+        result = self.execute("system", "df", "--format", "{{ .Type }}|{{ .Size }}", use_stdout_pipe=True)
+        types = dict(line.split('|', 1) for line in (result.stdout or '').split('\n') if line)
+        return sum(parse_size(types.get(name, "0"), unit=1000) for name in ("Images", "Containers"))
+
+    def list_image_sizes(self):
+        result = self.execute("images", "--format", "{{ .Repository }}:{{ .Tag }}|{{ .Size }}", use_stdout_pipe=True)
+        sizes = (line.split('|') for line in (result.stdout or '').split('\n') if line)
+        return {reference: parse_size(size, unit=1000) for reference, size in sizes}
+
+    def list_container_sizes(self):
+        result = self.execute("ps", "-a", "-s", "--filter", f"label={RUN_FINGERPRINT_LABEL}", "--format",
+                              "{{ .Names }}|{{ .Size }}", use_stdout_pipe=True)
+        # Sizes are written as "<writable size> (virtual <size with the image>)"
+        sizes = (line.split('|') for line in (result.stdout or '').split('\n') if line)
+        return {name: parse_size(size.split()[0], unit=1000) for name, size in sizes}
+
+    def save_image(self, name, read_archive):
+        command = [self._docker_executable, "save", name]
+        self._logger.debug(f"Execute: \"{' '.join(command)}\"")
+        with PROFILER.span("docker save", "docker", argv=command) as span, \
+                subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self._environ) as pipe:
+            try:
+                result, error = read_archive(pipe.stdout), None
+            except tarfile.TarError as exception:
+                # An archive cut short is reported along with the error of docker, if any
+                result, error = None, exception
+            pipe.stdout.read()
+            stderr = pipe.stderr.read().decode('utf-8', errors='replace')
+            pipe.wait()
+            span.args.update(return_code=pipe.returncode)
+        if pipe.returncode != 0:
+            self._report_error(' '.join(command), pipe.returncode, stderr)
+        if error is not None:
+            raise error
+        return result
+
+    def _load_image(self, write_archive, use_ignored_errors=False):
+        command = [self._docker_executable, "load", "-q"]
+        self._logger.debug(f"Execute: \"{' '.join(command)}\"")
+        with PROFILER.span("docker load", "docker", argv=command) as span, \
+                subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 env=self._environ) as pipe:
+            try:
+                write_archive(pipe.stdin)
+            except BrokenPipeError:
+                # Docker has stopped reading the archive, whose error is reported below
+                pass
+            finally:
+                try:
+                    pipe.stdin.close()
+                except BrokenPipeError:
+                    pass
+            output = pipe.stdout.read().decode('utf-8', errors='replace')
+            pipe.wait()
+            span.args.update(return_code=pipe.returncode)
+        if not use_ignored_errors and pipe.returncode != 0:
+            self._report_error(' '.join(command), pipe.returncode, output)
+        return self.DockerResult(stdout=output, stderr=output if pipe.returncode else None,
+                                 return_code=pipe.returncode)
+
+    def iter_events(self, since=None):
+        args = ["--since", str(since)] if since is not None else []
+        for line in self.execute_stream("events", *args, "--filter", "type=container", "--filter", "type=image",
+                                        "--format", "{{json .}}"):
+            yield loads_json(line)
+
+    def _clone(self, logger: logging.Logger, environ):
+        return DockerCLI(self._docker_executable, logger, environ=environ)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+class DockerAPI(Docker):
+    """Talks to the Docker Engine HTTP API over a unix socket.
+
+    A single keep-alive connection is opened lazily and reused by every request of the invocation, so no
+    docker executable is forked except for the interactive ``exec`` used by ``attach``.
+    """
+
+    RUN_VALUED_OPTIONS = {"-v", "--volume", "-p", "--publish", "--net", "--network", "--device", "-e", "--env",
+                          "--gpus", "-u", "--user", "--hostname", "-h", "--cap-add", "--cap-drop", "--security-opt",
+                          "--shm-size", "-l", "--label", "--ipc", "-w", "--workdir", "--entrypoint"}
+
+    def __init__(self, socket_path, logger: logging.Logger, environ=None):
+        super(DockerAPI, self).__init__(logger, environ=environ)
+        self._socket_path = socket_path
+        self._connection = UnixHTTPConnection(socket_path)
+
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+    def get_version(self):
+        result = self.request("GET", "/version")
+        version = loads_json(result.stdout).get("Version")
+        if not version or not re.match(r"\d+\.\d+\.\d+", version):
+            raise RuntimeError(f"Cannot parse docker version from \"{result.stdout}\"")
+        return packaging.version.parse(re.match(r"\d+\.\d+\.\d+", version).group(0))
+
+    def _send(self, method, path, query=None, body=None, headers=None, use_dry_run=False):
+        if query:
+            path = f"{path}?{urllib.parse.urlencode(query)}"
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = dumps_json(body, indent=None).encode('utf-8')
+            headers.setdefault("Content-Type", "application/json")
+
+        stringified_request = f"{method} {path}"
+        if use_dry_run:
+            self._logger.debug(f"Request (dry-run): \"{stringified_request}\"")
+            return stringified_request, None
+        self._logger.debug(f"Request: \"{stringified_request}\"")
+
+        self._connection.request(method, path, body=body, headers=headers)
+        return stringified_request, self._connection.getresponse()
+
+    def _report_request_error(self, stringified_request, status, message):
+        self._logger.critical(f"An error has occurred when requesting docker engine.\n"
+                              f"Request: {stringified_request}\n"
+                              f"Status: {status}\n"
+                              f"Message:\n"
+                              f"{row_pad_prefix(message or '', '... ')}\n")
+        raise RuntimeError("An error has occurred when requesting docker engine.")
+
+    def request(self, method, path, query=None, body=None, headers=None, use_ignored_errors=False,
+                use_dry_run=False):
+        with PROFILER.span(f"{method} {path}", "docker", query=query) as span:
+            stringified_request, response = self._send(method, path, query, body, headers, use_dry_run)
+            if response is None:
+                return None
+            stdout, stderr = response.read().decode('utf-8'), None
+            span.args.update(status=response.status, stdout_bytes=len(stdout))
+        if response.status >= 400:
+            try:
+                stderr = loads_json(stdout).get("message", stdout)
+            except ValueError:
+                stderr = stdout
+            if not use_ignored_errors:
+                self._report_request_error(stringified_request, response.status, stderr)
+        return_code = 0 if response.status < 400 else response.status
+        return self.DockerResult(stdout=stdout, stderr=stderr, return_code=return_code)
+
+    def request_stream(self, method, path, query=None, body=None, headers=None, use_dry_run=False):
+        """Sends a request whose response is a stream of JSON messages, and yields the messages as they arrive.
+
+        Only the latest ``FAILURE_REPORT_LINES`` output lines are kept for the report logged when an error occurs.
+        """
+        with PROFILER.span(f"{method} {path}", "docker", query=query) as span:
+            stringified_request, response = self._send(method, path, query, body, headers, use_dry_run)
+            if response is None:
+                return
+            span.args.update(status=response.status)
+            if response.status >= 400:
+                self._report_request_error(stringified_request, response.status, response.read().decode('utf-8'))
+
+            tail = collections.deque(maxlen=FAILURE_REPORT_LINES)
+            for line in iter(response.readline, b''):
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                message = loads_json(line)
+                if "error" in message:
+                    response.read()
+                    tail.append(message["error"])
+                    self._report_request_error(stringified_request, response.status, '\n'.join(tail))
+                tail.extend(message.get("stream", '').splitlines())
+                yield message
+            response.read()  # Drains the response so that the connection can be reused
+
+    def list_images(self, reference=None):
+        query = {"filters": dumps_json({"reference": [reference]}, indent=None)} if reference is not None else None
+        images = loads_json(self.request("GET", "/images/json", query=query).stdout)
+        return [ImageInfo(tag, image["Id"]) for image in images for tag in (image.get("RepoTags") or [])]
+
+    def list_containers(self, name=None):
+        query = {"all": 1}
+        if name is not None:
+            query["filters"] = dumps_json({"name": [f"^/?{re.escape(name)}$"]}, indent=None)
+        containers = loads_json(self.request("GET", "/containers/json", query=query).stdout)
+        return [ContainerInfo(container["Names"][0].lstrip('/'), container["Image"], container["Status"],
+                              (container.get("Labels") or dict()).get(RUN_FINGERPRINT_LABEL, ''))
+                for container in containers if container.get("Names")]
+
+    def inspect_image(self, name):
+        return loads_json(self.request("GET", f"/images/{urllib.parse.quote(name, safe='')}/json").stdout)
+
+    def _build_image(self, name, path, build_args, labels=None, use_no_cache=False, use_dry_run=False):
+        query = {"t": name, "rm": 1, "buildargs": dumps_json(build_args, indent=None),
+                 "labels": dumps_json(labels or dict(), indent=None)}
+        if use_no_cache:
+            query["nocache"] = 1
+        if use_dry_run:
+            return self.request("POST", "/build", query=query, use_dry_run=True)
+
+        with tempfile.TemporaryFile() as context:
+            with tarfile.open(fileobj=context, mode="w") as writer:
+                for relative_path in get_context_files(path):
+                    writer.add(os.path.join(path, relative_path), arcname=relative_path, recursive=False)
+            headers = {"Content-Type": "application/x-tar", "Content-Length": str(context.tell())}
+            context.seek(0)
+
+            progress = BuildProgress(self._logger)
+            for message in self.request_stream("POST", "/build", query=query, body=context, headers=headers):
+                for line in message.get("stream", '').splitlines():
+                    progress.feed(line)
+            progress.close()
+
+    def _pull_image(self, name, use_dry_run=False):
+        # The reference may carry its tag or digest, which the engine splits itself
+        for message in self.request_stream("POST", "/images/create", query={"fromImage": name},
+                                           use_dry_run=use_dry_run):
+            if message.get("status"):
+                self._logger.debug(f"Pull {name}: {message['status']}")
 
-            if isinstance(config.runtime.networks, dict):
-                for k, v in config.runtime.networks.items():
-                    args.extend(['-p', f"{k}:{v}"])
+    def _get_container_spec(self, image, args):
+        host_config = {"Binds": [], "PortBindings": {}, "Devices": [], "CapAdd": [], "CapDrop": [],
+                       "SecurityOpt": []}
+        spec = {"Image": image, "Tty": True, "OpenStdin": False, "Env": [], "Labels": {}, "ExposedPorts": {},
+                "HostConfig": host_config}
+
+        iterator = iter(args)
+        for arg in iterator:
+            arg = str(arg)
+            if arg.startswith("--") and '=' in arg:
+                option, value = arg.split('=', 1)
             else:
-                raise ValueError("Runtime network setting cannot be analyzed")
-
-        # Handling device pass-through
-        if isinstance(config.runtime.devices, str):
-            config.runtime.devices = config.preset.runtime.devices[config.runtime.devices]
-        if config.runtime.devices:
-            devices = []
-            for device_pattern in config.runtime.devices:
-                devices.extend(glob.glob(device_pattern))
-            for device in devices:
-                self._logger.debug(f"Find device: {device}")
-                args.extend(["--device", device])
-
-        # Handling environment
-        if config.runtime.environment:
-            for key, value in config.runtime.environment.items():
-                if value is None:
-                    args.extend(["--env", str(key)])
-                else:
-                    args.append(["--env", f"{key}={value}"])
-
-        # Handling other attributes
-        if config.runtime.attributes.use_gpus:
-            args.extend(["--gpus", "all"])
-        if config.runtime.attributes.use_privileged:
-            args.append("--privileged")
-        if config.runtime.attributes.use_user_permission:
-            args.extend(["-u", f"{os.geteuid()}:{os.getegid()}"])
-        if config.runtime.attributes.use_hostname:
-            args.extend(["--hostname", socket.gethostname()])
-
-        args.extend(config.runtime.extra_args)
-
-        self.execute(
-            "run", "-td", "--name", config.runtime.name, *args,
-            config.library.name, use_dry_run=config.dry_run
-        )
+                option, value = arg, None
+            if option in self.RUN_VALUED_OPTIONS and value is None:
+                value = str(next(iterator))
 
-    def clean(self, config):
-        runtime_status = self.get_runtime_status(config)
-        if runtime_status is not None:
-            if runtime_status.startswith("Up"):
-                self.execute("stop", config.runtime.name, use_dry_run=config.dry_run)
-            self.execute("rm", config.runtime.name, use_dry_run=config.dry_run)
+            if option in ("-v", "--volume"):
+                host_config["Binds"].append(value)
+            elif option in ("-p", "--publish"):
+                host_port, container_port = value.rsplit(':', 1)
+                if '/' not in container_port:
+                    container_port = f"{container_port}/tcp"
+                host_ip, _, host_port = host_port.rpartition(':')
+                spec["ExposedPorts"][container_port] = {}
+                host_config["PortBindings"].setdefault(container_port, []).append(
+                    {"HostIp": host_ip, "HostPort": host_port})
+            elif option in ("--net", "--network"):
+                host_config["NetworkMode"] = value
+            elif option == "--device":
+                source, _, target = value.partition(':')
+                host_config["Devices"].append(
+                    {"PathOnHost": source, "PathInContainer": target or source, "CgroupPermissions": "rwm"})
+            elif option in ("-e", "--env"):
+                if '=' in value:
+                    spec["Env"].append(value)
+                elif value in os.environ:
+                    spec["Env"].append(f"{value}={os.environ[value]}")
+            elif option == "--gpus":
+                if value != "all":
+                    raise ValueError(f"Only \"--gpus all\" is supported by the API backend (got \"{value}\")")
+                host_config["DeviceRequests"] = [{"Driver": "", "Count": -1, "Capabilities": [["gpu"]]}]
+            elif option == "--privileged":
+                host_config["Privileged"] = True
+            elif option in ("-u", "--user"):
+                spec["User"] = value
+            elif option in ("-h", "--hostname"):
+                spec["Hostname"] = value
+            elif option == "--cap-add":
+                host_config["CapAdd"].append(value)
+            elif option == "--cap-drop":
+                host_config["CapDrop"].append(value)
+            elif option == "--security-opt":
+                host_config["SecurityOpt"].append(value)
+            elif option == "--shm-size":
+                host_config["ShmSize"] = parse_size(value)
+            elif option in ("-l", "--label"):
+                key, _, label = value.partition('=')
+                spec["Labels"][key] = label
+            elif option == "--ipc":
+                host_config["IpcMode"] = value
+            elif option in ("-w", "--workdir"):
+                spec["WorkingDir"] = value
+            elif option == "--entrypoint":
+                spec["Entrypoint"] = [value]
+            else:
+                raise ValueError(f"Docker run option \"{arg}\" is not supported by the API backend")
+        return spec
 
-        if getattr(config, "with_images", False) and self.is_built(config):
-            self.execute("rmi", config.library.name, use_dry_run=config.dry_run)
+    def _run_container(self, name, image, args, labels=None, use_dry_run=False):
+        spec = self._get_container_spec(image, args)
+        spec["Labels"].update(labels or dict())
+        self._logger.debug(f"Container spec: {dumps_json(spec, indent=None)}")
+        self.request("POST", "/containers/create", query={"name": name}, body=spec, use_dry_run=use_dry_run)
+        return self._start_container(name, use_dry_run=use_dry_run)
 
-    def attach(self, config):
-        if not self.is_built(config):
-            self.build(config)
+    def _start_container(self, name, use_dry_run=False):
+        return self.request("POST", f"/containers/{urllib.parse.quote(name, safe='')}/start", use_dry_run=use_dry_run)
 
-        runtime_status = self.get_runtime_status(config)
-        if runtime_status is None:
-            self.start(config)
+    def _stop_container(self, name, use_dry_run=False):
+        return self.request("POST", f"/containers/{urllib.parse.quote(name, safe='')}/stop", use_dry_run=use_dry_run)
+
+    def _remove_container(self, name, use_dry_run=False):
+        return self.request("DELETE", f"/containers/{urllib.parse.quote(name, safe='')}", use_dry_run=use_dry_run)
+
+    def _remove_image(self, name, use_dry_run=False):
+        return self.request("DELETE", f"/images/{urllib.parse.quote(name, safe='')}", use_dry_run=use_dry_run)
+
+    def get_disk_usage(self):
+        usage = loads_json(self.request("GET", "/system/df").stdout)
+        return (usage.get("LayersSize") or 0) + sum(container.get("SizeRw") or 0
+                                                    for container in usage.get("Containers") or [])
+
+    def list_image_sizes(self):
+        images = loads_json(self.request("GET", "/images/json").stdout)
+        return {tag: image["Size"] for image in images for tag in (image.get("RepoTags") or [])}
+
+    def list_container_sizes(self):
+        query = {"all": 1, "size": 1, "filters": dumps_json({"label": [RUN_FINGERPRINT_LABEL]}, indent=None)}
+        containers = loads_json(self.request("GET", "/containers/json", query=query).stdout)
+        return {container["Names"][0].lstrip('/'): container.get("SizeRw") or 0
+                for container in containers if container.get("Names")}
+
+    def save_image(self, name, read_archive):
+        path = f"/images/{urllib.parse.quote(name, safe='')}/get"
+        with PROFILER.span(f"GET {path}", "docker") as span:
+            stringified_request, response = self._send("GET", path)
+            span.args.update(status=response.status)
+            if response.status >= 400:
+                self._report_request_error(stringified_request, response.status, response.read().decode('utf-8'))
+            try:
+                result = read_archive(response)
+                response.read()
+            except BaseException:
+                # The rest of the response is not read, so the connection cannot be reused
+                self._connection.close()
+                raise
+        return result
+
+    def _load_image(self, write_archive, use_ignored_errors=False):
+        # The archive is written to a pipe by another thread, and the pipe is sent with chunked encoding
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def write():
+            try:
+                with open(write_fd, "wb") as writer:
+                    write_archive(writer)
+            except BrokenPipeError:
+                pass
+            except BaseException as exception:
+                errors.append(exception)
+
+        thread = threading.Thread(target=write, name="load_image", daemon=True)
+        thread.start()
+        try:
+            with open(read_fd, "rb") as reader:
+                result = self.request("POST", "/images/load", query={"quiet": 1}, body=reader,
+                                      headers={"Content-Type": "application/x-tar"}, use_ignored_errors=True)
+        finally:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        # Errors of a started load are reported in its stream of messages instead of its status
+        stderr = result.stderr
+        if result.return_code == 0:
+            messages = [loads_json(line) for line in result.stdout.splitlines() if line.strip()]
+            stderr = '\n'.join(message["error"] for message in messages if "error" in message) or None
+        if stderr is not None and not use_ignored_errors:
+            self._report_request_error("POST /images/load", result.return_code or 500, stderr)
+        return self.DockerResult(stdout=result.stdout, stderr=stderr,
+                                 return_code=result.return_code or (1 if stderr is not None else 0))
+
+    def exec_container(self, name, command):
+        # Interactive sessions need a hijacked TTY stream, which is left to the docker client
+        docker_executable = shutil.which("docker")
+        if docker_executable is None:
+            raise RuntimeError("Attaching through the API backend requires a docker client executable")
+        environ = dict(self._environ if self._environ is not None else os.environ,
+                       DOCKER_HOST=f"unix://{self._socket_path}")
+        stringified_command = f"{docker_executable} exec -it {name} {command}"
+        self._logger.debug(f"Execute: \"{stringified_command}\"")
+        return_code = subprocess.call([docker_executable, "exec", "-it", name, command], env=environ)
+        if return_code != 0:
+            # The error of docker is printed to the terminal along with the session
+            self._report_error(stringified_command, return_code, None)
+        return self.DockerResult(stdout=None, stderr=None, return_code=return_code)
+
+    def iter_events(self, since=None):
+        query = {"filters": dumps_json({"type": ["container", "image"]}, indent=None)}
+        if since is not None:
+            query["since"] = str(since)
+        yield from self.request_stream("GET", "/events", query=query)
+
+    def _clone(self, logger: logging.Logger, environ):
+        return DockerAPI(self._socket_path, logger, environ=environ)
 
-        self.execute("exec", "-it", config.runtime.name, config.runtime.attach_entrypoint)
 
+def parse_size(text, unit=1024):
+    # Docker writes its sizes (such as "1.2GB") with a unit of 1000
+    units = {"": 1, "b": 1, "k": unit, "m": unit ** 2, "g": unit ** 3, "t": unit ** 4}
+    matched = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)(?:i?b)?\s*", str(text), flags=re.IGNORECASE)
+    if matched is None:
+        raise ValueError(f"Cannot parse size \"{text}\"")
+    return int(float(matched.group(1)) * units[matched.group(2).lower()])
 
-def get_config(args):
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "never"
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+@profiled("get_config")
+def get_config(args, path=None):
+    path = path or getattr(args, "path", None)
     dictifier = AttrListDictifier()
     dict_merger = ListDictMerger()
     config = DEFAULT_CONFIG
-    config = dict_merger.merge(config, vars(args))
+    config = dict_merger.merge(config, dict(vars(args), path=path))
     if os.path.isfile("defaults.json"):
         config = dict_merger.merge(config, load_json("defaults.json"))
-    config = dict_merger.merge(config, load_json(os.path.join(args.path, "config.json")))
+    if path is not None:
+        config = dict_merger.merge(config, load_json(os.path.join(path, "config.json")))
     return dictifier.dictify(config)
 
 
+def get_library_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if glob.escape(pattern) == pattern:
+            matched = [pattern]
+        else:
+            matched = sorted(path for path in glob.glob(pattern) if os.path.isfile(os.path.join(path, "config.json")))
+            if not matched:
+                raise ValueError(f"Pattern \"{pattern}\" does not match any library")
+        for path in matched:
+            if all(not os.path.samefile(path, existing) for existing in paths):
+                paths.append(path)
+    return paths
+
+
+def get_library_bases(path):
+    """Returns the images that the ``FROM`` instructions of a library's Dockerfile are built on."""
+    with open(os.path.join(path, "Dockerfile"), "r") as reader:
+        content = re.sub(r"\\\s*\n", " ", reader.read())
+
+    arguments, stages, bases = dict(), set(), list()
+    for line in content.split('\n'):
+        matched = re.match(r"\s*ARG\s+([A-Za-z_][A-Za-z0-9_]*)(?:=(\S*))?", line, flags=re.IGNORECASE)
+        if matched and not stages and not bases:
+            arguments[matched.group(1)] = (matched.group(2) or '').strip('"\'')
+            continue
+        matched = re.match(r"\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?", line, flags=re.IGNORECASE)
+        if matched:
+            image = string.Template(matched.group(1)).safe_substitute(arguments)
+            if image.lower() not in stages and image != "scratch":
+                bases.append(image)
+            if matched.group(2):
+                stages.add(matched.group(2).lower())
+    return bases
+
+
+def get_library_dependencies(configs):
+    libraries = {get_image_reference(config.library.name): path for path, config in configs.items()}
+    dependencies = dict()
+    for path, config in configs.items():
+        dependencies[path] = set()
+        for base in get_library_bases(path):
+            base_path = libraries.get(get_image_reference(base))
+            if base_path is not None and base_path != path:
+                dependencies[path].add(base_path)
+    return dependencies
+
+
+def get_library_action(docker, action):
+    # ``import`` is a keyword, so the transfers of libraries are named after libraries
+    return getattr(docker, f"{action}_library" if action in ("export", "import") else action)
+
+
+def run_libraries(args, logger):
+    """Runs an action on several libraries, where a library only runs after the libraries it is built ``FROM``.
+
+    Independent libraries run concurrently on at most ``args.jobs`` workers. A failed library only skips the
+    libraries depending on it, and a summary with the status and time of every library is logged at the end.
+    """
+    paths = get_library_paths(args.path)
+    if len(paths) == 1:
+        config = get_config(args, paths[0])
+        get_library_action(get_docker(config, logger), args.action)(config)
+        return
+
+    configs = {path: get_config(args, path) for path in paths}
+    dependencies = get_library_dependencies(configs)
+    if args.action == "clean":
+        # Dependent libraries are cleaned before their bases
+        dependencies = {path: {other for other in paths if path in dependencies[other]} for path in paths}
+
+    def run_library(path):
+        library_logger = logger.getChild(os.path.basename(os.path.normpath(path)))
+        start_time = time.time()
+        try:
+            with PROFILER.span(f"{args.action} {path}"):
+                docker = get_docker(configs[path], library_logger)
+                get_library_action(docker, args.action)(configs[path])
+        except BaseException:
+            library_logger.exception(f"Unable to {args.action} library \"{path}\"")
+            return False, time.time() - start_time
+        return True, time.time() - start_time
+
+    results = dict()
+    remaining = dict((path, set(dependencies[path])) for path in paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = dict()
+        while remaining or futures:
+            for path in list(remaining):
+                if any(results.get(base, ("success",))[0] != "success" for base in remaining[path]):
+                    results[path] = ("skipped", 0.0)
+                    del remaining[path]
+                elif all(base in results for base in remaining[path]):
+                    futures[executor.submit(run_library, path)] = path
+                    del remaining[path]
+            if not futures:
+                if remaining:
+                    raise ValueError(f"Libraries {sorted(remaining)} have cyclic FROM dependencies")
+                break
+
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                is_successful, elapsed_time = future.result()
+                results[futures.pop(future)] = ("success" if is_successful else "failed", elapsed_time)
+
+    summary = {path: f"{results[path][0]:<8} {results[path][1]:.2f}s" for path in paths}
+    logger.info(f"Summary of {args.action}:\n{dumps_table(summary, indent=4)}")
+    failures = [path for path in paths if results[path][0] != "success"]
+    if failures:
+        raise RuntimeError(f"Unable to {args.action} libraries: {', '.join(failures)}")
+
+
+def get_docker_key(config):
+    """Returns the key of the backend resolved for a configuration, which is shared by libraries on the same docker.
+    The docker executable talks to the daemon selected by the environment, so its variables are a part of the key."""
+    return dumps_json([config.dockers, bool(config.runtime.attributes.use_gpus), os.environ.get("DOCKER_HOST"),
+                       os.environ.get("DOCKER_CONTEXT")], indent=None, sort_keys=True)
+
+
+DockerCapability = collections.namedtuple("DockerCapability",
+                                          ['backend', 'path', 'identity', 'status', 'version', 'latency', 'expiration'])
+
+
+def has_gpus_support(predicate, version):
+    """Evaluates the ``has_gpus_support`` option of a docker, which is a boolean or ``[variable, predicate, value]``."""
+    if not isinstance(predicate, list):
+        return bool(predicate)
+    if len(predicate) != 3:
+        raise ValueError("has_gpus_support should be of the form [value, predicate, value]")
+    if predicate[0] != "docker_version":
+        raise ValueError(f"Cannot interpret variable \"{predicate[0]}\"")
+    value, operator = packaging.version.parse(predicate[2]), predicate[1].lower()
+    if operator in (">", "larger"):
+        return version > value
+    elif operator in ("<", "less"):
+        return version < value
+    elif operator in ("<=", "less_equal"):
+        return version <= value
+    elif operator in (">=", "larger_equal"):
+        return version >= value
+    elif operator in ("==", "equal"):
+        return version == value
+    elif operator in ('!=', "<>", "not_equal"):
+        return version != value
+    raise ValueError(f"Unrecognized predicate \"{predicate[1]}\"")
+
+
+class DockerProber(object):
+    """Resolves the dockers of ``config.dockers`` into their paths, versions and statuses, with a per-host cache.
+
+    A cached capability stays valid as long as the path, the inode and the mtime of the executable (or of the engine
+    socket) are unchanged, so choosing a docker usually starts no process at all. Versions are only probed when
+    asked for, concurrently and each with a timeout, and a failed or hung probe is remembered for ``failure_ttl``
+    seconds so that a broken wrapper does not stall the following invocations.
+    """
+
+    def __init__(self, timeout=DOCKER_PROBE_TIMEOUT, failure_ttl=DOCKER_PROBE_FAILURE_TTL):
+        self._lock = threading.Lock()
+        self._timeout = timeout
+        self._failure_ttl = failure_ttl
+        self._cache_path = get_cache_path(f"dockers.{socket.gethostname()}.json")
+        try:
+            self._capabilities = {name: DockerCapability(*entry) for name, entry in load_json(self._cache_path).items()}
+        except (OSError, ValueError, TypeError):
+            self._capabilities = dict()
+
+    @property
+    def cache_path(self):
+        return self._cache_path
+
+    @staticmethod
+    def create_docker(backend, path, logger: logging.Logger) -> 'Docker':
+        if backend == "api":
+            return DockerAPI(path, logger)
+        elif backend == "cli":
+            return DockerCLI(path, logger)
+        raise ValueError(f"Unrecognized docker backend \"{backend}\"")
+
+    @staticmethod
+    def _resolve(name, option):
+        backend = option.get("backend", "cli")
+        if backend == "api":
+            path = option.get("socket", DEFAULT_DOCKER_SOCKET)
+        elif backend == "cli":
+            path = shutil.which(name)
+        else:
+            raise ValueError(f"Unrecognized docker backend \"{backend}\"")
+        try:
+            stat = os.stat(path) if path is not None else None
+        except OSError:
+            stat = None
+        if stat is None:
+            return DockerCapability(backend, path, None, "missing", None, 0.0, None)
+        identity = [os.path.realpath(path), stat.st_ino, stat.st_mtime_ns]
+        return DockerCapability(backend, path, identity, "found", None, 0.0, None)
+
+    @synchronized_member_fn
+    def probe(self, dockers, logger: logging.Logger, names=None, use_refresh=False):
+        """Returns the ``DockerCapability`` of every docker, where the ones in ``names`` have their versions probed."""
+        capabilities, probed = dict(), dict()
+        for name, option in dockers.items():
+            capability = self._resolve(name, option)
+            cached = self._capabilities.get(name)
+            if not use_refresh and cached is not None and cached.identity == capability.identity and \
+                    cached.path == capability.path and (cached.expiration is None or cached.expiration > time.time()):
+                capability = cached
+            capabilities[name] = capability
+            if capability.status == "found" and (names is None or name in names):
+                probed[name] = capability
+
+        probes = probe_concurrently(probed, lambda name: self._probe_version(name, probed[name], logger),
+                                    self._timeout)
+        for name, capability in probed.items():
+            capabilities[name] = probes.get(name, capability._replace(
+                status="timeout", latency=self._timeout, expiration=time.time() + self._failure_ttl))
+            if capabilities[name].status != "ok":
+                logger.warning(f"Probed docker \"{name}\" in {capabilities[name].latency:.2f}s "
+                               f"({capabilities[name].status}), which is skipped")
+
+        if probed:
+            self._capabilities.update((name, capabilities[name]) for name in probed)
+            dump_json_atomically(self._cache_path, {name: list(capability)
+                                                    for name, capability in self._capabilities.items()})
+        return capabilities
+
+    def _probe_version(self, name, capability, logger):
+        start_time = time.time()
+        try:
+            version = self.create_docker(capability.backend, capability.path, logger).get_version()
+        except Exception as e:
+            logger.debug(f"Unable to probe the version of docker \"{name}\": {e}")
+            return capability._replace(status="failed", latency=time.time() - start_time,
+                                       expiration=time.time() + self._failure_ttl)
+        return capability._replace(status="ok", version=str(version), latency=time.time() - start_time)
+
+
+@functools.lru_cache(maxsize=None)
+def get_docker_prober():
+    return DockerProber()
+
+
+@profiled("get_docker")
 def get_docker(config, logger):
-    for name, option in config.dockers.items():
-        if shutil.which(name) is not None:
-            docker = DockerCLI(name, logger)
-
-            if not config.runtime.attributes.use_gpus:
-                return docker
-            if isinstance(option.has_gpus_support, list):
-                if len(option.has_gpus_support) != 3:
-                    raise ValueError("has_gpus_support should be of the form [value, predicate, value]")
-                if option.has_gpus_support[0] == "docker_version":
-                    option.has_gpus_support[0] = docker.version
-                else:
-                    raise ValueError(f"Cannot interpret variable \"{option.has_gpus_support[0]}\"")
-                option.has_gpus_support[2] = packaging.version.parse(option.has_gpus_support[2])
-                option.has_gpus_support[1] = option.has_gpus_support[1].lower()
-                if option.has_gpus_support[1] in (">", "larger"):
-                    option.has_gpus_support = (option.has_gpus_support[0] > option.has_gpus_support[2])
-                elif option.has_gpus_support[1] in ("<", "less"):
-                    option.has_gpus_support = (option.has_gpus_support[0] < option.has_gpus_support[2])
-                elif option.has_gpus_support[1] in ("<=", "less_equal"):
-                    option.has_gpus_support = (option.has_gpus_support[0] <= option.has_gpus_support[2])
-                elif option.has_gpus_support[1] in (">=", "larger_equal"):
-                    option.has_gpus_support = (option.has_gpus_support[0] >= option.has_gpus_support[2])
-                elif option.has_gpus_support[1] in ("==", "equal"):
-                    option.has_gpus_support = (option.has_gpus_support[0] == option.has_gpus_support[2])
-                elif option.has_gpus_support[1] in ('!=', "<>", "not_equal"):
-                    option.has_gpus_support = (option.has_gpus_support[0] != option.has_gpus_support[2])
-                else:
-                    raise ValueError(f"Unrecognized predicate \"{option.has_gpus_support[1]}\"")
+    if SERVING_DAEMON is not None:
+        docker = SERVING_DAEMON.clone_backend(config, logger)
+        if docker is not None:
+            return docker
 
-            if option.has_gpus_support:
-                return docker
+    use_gpus = bool(config.runtime.attributes.use_gpus)
+    # Only the GPU support of a docker may depend on its version
+    names = [name for name, option in config.dockers.items() if use_gpus and isinstance(option.has_gpus_support, list)]
+    capabilities = get_docker_prober().probe(config.dockers, logger, names=names)
+    for name, option in config.dockers.items():
+        capability = capabilities[name]
+        if capability.status not in ("found", "ok"):
+            continue
+        version = packaging.version.parse(capability.version) if capability.version is not None else None
+        if not use_gpus or has_gpus_support(option.has_gpus_support, version):
+            return DockerProber.create_docker(capability.backend, capability.path, logger)
 
     raise RuntimeError("Unable to find any valid docker")
 
 
+class CuratorDaemon(object):
+    """Serves the actions of ``curatorc.py`` (or ``curator.py``) clients over a unix socket (``curator.py daemon``).
+
+    The daemon keeps the docker backends resolved for the served libraries with their states, which are listed once
+    and then kept current by subscribing to ``docker events``. Every action is run by a forked process in the
+    directory and with the environment of the client, and with the standard streams of the client passed over the
+    socket, so it prompts and attaches on the terminal of the client while starting from the warm backends. Before
+    reporting its exit status, the process reports the images and containers it has changed, which are invalidated in
+    the states before the next action is forked, instead of waiting for their events.
+    """
+
+    def __init__(self, socket_path, logger: logging.Logger):
+        self._socket_path = socket_path
+        self._logger = logger
+        self._server = None
+        self._backends = dict()
+        # Backends cloned by the served action, along with their keys
+        self._clones = []
+        # Datagrams of the changes reported by the served actions, which are applied under the lock
+        self._reports = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._reports[0].setblocking(False)
+        self._reports_lock = threading.Lock()
+
+    def clone_backend(self, config, logger: logging.Logger):
+        key = get_docker_key(config)
+        if key not in self._backends:
+            return None
+        docker = self._backends[key].clone(logger, environ=dict(os.environ))
+        self._clones.append((key, docker))
+        return docker
+
+    def _add_backend(self, config):
+        key = get_docker_key(config)
+        if key in self._backends:
+            return
+        # The backend spawns docker with the environment it is resolved in, whatever the environment of the daemon is
+        docker = get_docker(config, self._logger).clone(self._logger, environ=dict(os.environ))
+        since = int(time.time())
+        docker.state.refresh()
+        self._backends[key] = docker
+        threading.Thread(target=self._watch_events, args=(docker, since), daemon=True).start()
+        self._logger.info(f"Watching the events of {type(docker).__name__} backend for {list(config.dockers)}")
+
+    def _watch_events(self, docker, since):
+        delay = 1.0
+        while True:
+            try:
+                for event in docker.clone(self._logger).iter_events(since=since):
+                    docker.state.apply_event(event)
+                    delay = 1.0
+                    self._logger.debug(f"Applied {event.get('Type')} event \"{event.get('Action')}\"")
+                error = "the stream has ended"
+            except Exception as e:
+                error = e
+            # Changes are missed until the events are watched again, so the entries are queried by every action
+            docker.state.invalidate_all()
+            self._logger.warning(f"Lost the events of the docker daemon ({error}), reconnecting in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, DAEMON_EVENTS_RETRY_DELAY)
+            # The events since the state is listed again are replayed on it
+            since = int(time.time())
+            try:
+                docker.state.refresh()
+            except Exception as e:
+                self._logger.warning(f"Cannot list the images and containers of the docker daemon ({e})")
+
+    def _apply_reports(self):
+        # A report being applied by another thread is waited for, so it is applied once this returns
+        with self._reports_lock:
+            while True:
+                try:
+                    report = loads_json(self._reports[0].recv(1 << 20))
+                except BlockingIOError:
+                    return
+                for key, changes in report.items():
+                    if key in self._backends:
+                        self._backends[key].state.apply_changes(changes)
+
+    def _watch_reports(self):
+        while True:
+            try:
+                select.select([self._reports[0]], [], [])
+                self._apply_reports()
+            except Exception as e:
+                self._logger.warning(f"Cannot apply the changes reported by an action: {e}")
+
+    def _report_changes(self):
+        report = dict()
+        for key, docker in self._clones:
+            changes = report.setdefault(key, {"images": [], "containers": []})
+            for kind, names in docker.state.get_changes().items():
+                changes[kind].extend(names)
+        if report:
+            self._reports[1].send(dumps_json(report, indent=None).encode('utf-8'))
+
+    def _prepare(self, request):
+        # The backends are resolved in the directory and with the environment of the client, which are restored
+        # afterwards, and only the served action runs with them
+        directory, environ = os.getcwd(), dict(os.environ)
+        try:
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["environ"])
+            args = get_argument_parser().parse_args(request["argv"])
+            if args.action in ("build", "start", "clean", "attach"):
+                for path in get_library_paths(args.path if isinstance(args.path, list) else [args.path]):
+                    self._add_backend(get_config(args, path))
+        finally:
+            os.chdir(directory)
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def _serve(self, connection, fds, request):
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._server.close()
+            self._reports[0].close()
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["environ"])
+            # Leaves the terminal of the daemon (if any), so that the terminal of the client can be read
+            os.setsid()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            connection.sendall(dumps_json({"pid": os.getpid()}, indent=None).encode('utf-8') + b"\n")
+            threading.Thread(target=self._relay_signals, args=(connection,), daemon=True).start()
+
+            args = get_argument_parser().parse_args(request["argv"])
+            if args.action == "daemon":
+                raise RuntimeError("The daemon is already running")
+            main(args)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                self._report_changes()
+                connection.sendall(dumps_json({"status": status}, indent=None).encode('utf-8') + b"\n")
+            finally:
+                os._exit(status)
+
+    def _reap(self, pid):
+        # Only the served processes are waited for, so that the docker processes of the daemon keep their statuses
+        _, status = os.waitpid(pid, 0)
+        self._logger.debug(f"Process {pid} has exited with status {os.waitstatus_to_exitcode(status)}")
+
+    @staticmethod
+    def _relay_signals(connection):
+        # Signals from the terminal of the client go to the whole process group, as they would in direct mode
+        for line in connection.makefile("rb"):
+            os.killpg(0, loads_json(line)["signal"])
+
+    def _accept(self, connection):
+        message, fds = b'', []
+        while not message.endswith(b"\n"):
+            data, received_fds, _, _ = socket.recv_fds(connection, 1 << 16, 3)
+            if not data and not message:
+                return  # Probed by a daemon being started
+            if not data:
+                raise ConnectionError("The client has disconnected")
+            message, fds = message + data, fds + received_fds
+        try:
+            if len(fds) != 3:
+                raise ConnectionError(f"The client has passed {len(fds)} file descriptors instead of 3")
+            request = loads_json(message)
+            # The changes of the actions served before are applied, as their clients may depend on them
+            self._apply_reports()
+            try:
+                self._prepare(request)
+            except (Exception, SystemExit) as e:
+                # The same error is raised again and reported to the client by the served action
+                self._logger.debug(f"Cannot resolve the backends of {request['argv']}: {e}")
+
+            # The states are locked so that no event watcher holds their locks in the forked process
+            states = [docker.state for docker in self._backends.values()]
+            for state in states:
+                state.lock.acquire()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                pid = os.fork()
+            finally:
+                for state in states:
+                    state.lock.release()
+            if pid == 0:
+                self._serve(connection, fds, request)
+            self._logger.info(f"Serving {request['argv']} in process {pid}")
+            threading.Thread(target=self._reap, args=(pid,), daemon=True).start()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def serve(self):
+        global SERVING_DAEMON
+        make_private_directory(os.path.dirname(self._socket_path))
+        if os.path.exists(self._socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(self._socket_path) == 0:
+                    raise RuntimeError(f"A daemon is already serving at {self._socket_path}")
+            os.remove(self._socket_path)
+
+        server = self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self._socket_path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        SERVING_DAEMON = self
+        threading.Thread(target=self._watch_reports, daemon=True).start()
+        # A termination still removes the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._logger.info(f"Serving at {self._socket_path}")
+        try:
+            while True:
+                connection, _ = server.accept()
+                with connection:
+                    try:
+                        self._accept(connection)
+                    except Exception as e:
+                        self._logger.warning(f"Cannot serve a client: {e}")
+        finally:
+            server.close()
+            os.remove(self._socket_path)
+
+
 def main(args):
     logger = get_default_logger("Curator", logger_level="DEBUG" if args.verbose else "INFO")
+    # Machine-readable outputs are printed to stdout, so logs go to stderr instead. The stream is set for every action
+    # since an action served by the daemon reuses the handler with the streams of the client.
+    for handler in logger.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(sys.stderr if args.action == "plan" else sys.stdout)
 
-    if args.action == "build":
-        config = get_config(args)
-        docker = get_docker(config, logger)
-        docker.build(config)
-    elif args.action == "start":
-        config = get_config(args)
-        docker = get_docker(config, logger)
-        docker.start(config)
-    elif args.action == "clean":
-        config = get_config(args)
-        docker = get_docker(config, logger)
-        docker.clean(config)
+    if args.profile is None or args.action == "daemon":
+        run_action(args, logger)
+        return
+    PROFILER.enable()
+    try:
+        with PROFILER.span(f"curator {args.action}"):
+            run_action(args, logger)
+    finally:
+        PROFILER.dump(args.profile)
+        logger.info(f"Profile of {args.action} (written to {args.profile}):\n{PROFILER.dumps_summary()}")
+
+
+def run_action(args, logger: logging.Logger):
+    if args.action in ("build", "start", "clean", "import"):
+        run_libraries(args, logger)
+    elif args.action == "export":
+        run_libraries(args, logger)
+        usage = LayerStore(args.store).get_usage()
+        logger.info(f"Layer store \"{args.store}\" has {usage.libraries} libraries: {format_size(usage.size)} of "
+                    f"archives, {format_size(usage.content_size)} of distinct content "
+                    f"(deduplicated {usage.size / max(usage.content_size, 1):.2f}x), {format_size(usage.stored_size)} "
+                    f"on disk (compressed {usage.content_size / max(usage.stored_size, 1):.2f}x)")
     elif args.action == "attach":
         config = get_config(args)
         docker = get_docker(config, logger)
         docker.attach(config)
+    elif args.action == "plan":
+        prober = MountProber(logger)
+        plan = load_run_plan(args.path, prober)
+        if plan is None:
+            # No docker is resolved, so the environment of the image comes from the manifest of the library
+            config = get_config(args)
+            plan = resolve_run_plan(config, functools.partial(get_recorded_library_variables, config), logger, prober)
+            dump_run_plan(plan)
+        output = dumps_json(label_run_plan_from_manifest(plan).to_json())
+        if args.output is None:
+            print(output)
+        else:
+            with open(args.output, "w") as writer:
+                writer.write(output)
+    elif args.action == "doctor":
+        config = get_config(args)
+        prober = get_docker_prober()
+        capabilities = prober.probe(config.dockers, logger, use_refresh=args.refresh)
+        table = dict()
+        for name, capability in capabilities.items():
+            version = packaging.version.parse(capability.version) if capability.version is not None else None
+            try:
+                gpus = "yes" if has_gpus_support(config.dockers[name].has_gpus_support, version) else "no"
+            except (TypeError, ValueError):
+                gpus = "unknown"
+            table[name] = f"{capability.backend:<4} {capability.status:<8} version {capability.version or '-':<10} " \
+                          f"gpus {gpus:<8} {capability.latency:6.3f}s  {capability.path or '-'}"
+        logger.info(f"Dockers on {socket.gethostname()} (cached in {prober.cache_path}):\n"
+                    f"{dumps_table(table, indent=4) if table else '    (none configured)'}")
+    elif args.action == "gc":
+        config = get_config(args)
+        get_docker(config, logger).collect_garbage(config)
+    elif args.action == "daemon":
+        CuratorDaemon(DAEMON_SOCKET, logger).serve()
     else:
         raise RuntimeError(f"Unrecognized action \"{args.action}\"")
 
 
-if __name__ == "__main__":
+def get_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+    parser.add_argument("--direct", action="store_true",
+                        help="run the action in this process even if a daemon is serving")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="write the timing of curator's phases and docker calls to a Chrome trace file")
 
     subparsers = parser.add_subparsers(dest="action", description="curator's action to manage library")
 
     subparser = subparsers.add_parser("build", description="build a docker library")
-    subparser.add_argument("path", type=str, help="path to the docker library to be built")
+    subparser.add_argument("path", type=str, nargs="+", help="paths (or globs) to the docker libraries to be built")
+    subparser.add_argument("-j", "--jobs", type=int, default=4, help="number of libraries to be built concurrently")
     subparser.add_argument("-f", "--force", action="store_true", help="force to build and ignore cache")
+    subparser.add_argument("--why", action="store_true", help="report which inputs of the libraries are changed")
     subparser.add_argument("--dry_run", action="store_true", help="only output docker commands")
     subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
 
     subparser = subparsers.add_parser("start", description="start a docker runtime from library")
-    subparser.add_argument("path", type=str, help="path to the docker library to be started")
+    subparser.add_argument("path", type=str, nargs="+", help="paths (or globs) to the docker libraries to be started")
+    subparser.add_argument("-j", "--jobs", type=int, default=4, help="number of libraries to be started concurrently")
+    subparser.add_argument("--why", action="store_true", help="report why the libraries are rebuilt")
+    subparser.add_argument("--recreate", action="store_true",
+                           help="recreate the containers even if they are created from the same image and options")
     subparser.add_argument("--dry_run", action="store_true", help="only output docker commands (ignore -b)")
     subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
 
     subparser = subparsers.add_parser("clean", description="start a docker runtime from library")
-    subparser.add_argument("path", type=str, help="path to the docker library for cleaning docker runtime")
+    subparser.add_argument("path", type=str, nargs="+",
+                           help="paths (or globs) to the docker libraries for cleaning docker runtime")
+    subparser.add_argument("-j", "--jobs", type=int, default=4, help="number of libraries to be cleaned concurrently")
     subparser.add_argument("-i", "--with_images", action="store_true", help="clean the docker images")
     subparser.add_argument("--dry_run", action="store_true", help="only output docker commands")
     subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
@@ -362,4 +2962,46 @@ if __name__ == "__main__":
     subparser.add_argument("--dry_run", action="store_true", help="only output docker commands")
     subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
 
-    main(parser.parse_args())
+    subparser = subparsers.add_parser("plan", description="resolve the docker commands to build and start a library")
+    subparser.add_argument("path", type=str, help="path to the docker library to be planned")
+    subparser.add_argument("-o", "--output", type=str, default=None, help="write the plan to a file (default: stdout)")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    subparser = subparsers.add_parser("export", description="export docker libraries to a deduplicated layer store")
+    subparser.add_argument("path", type=str, nargs="+", help="paths (or globs) to the docker libraries to be exported")
+    subparser.add_argument("-s", "--store", type=str, required=True,
+                           help="directory of the layer store, which can be shared by hosts")
+    subparser.add_argument("-j", "--jobs", type=int, default=4, help="number of libraries to be exported concurrently")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    subparser = subparsers.add_parser("import", description="import docker libraries from a layer store")
+    subparser.add_argument("path", type=str, nargs="+", help="paths (or globs) to the docker libraries to be imported")
+    subparser.add_argument("-s", "--store", type=str, required=True, help="directory of the layer store")
+    subparser.add_argument("-j", "--jobs", type=int, default=4, help="number of libraries to be imported concurrently")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    subparser = subparsers.add_parser("doctor", description="show the dockers of this host and their capabilities")
+    subparser.add_argument("path", type=str, nargs="?", default=None,
+                           help="path to a docker library whose configuration is used (default: only defaults.json)")
+    subparser.add_argument("--refresh", action="store_true", help="probe the dockers again instead of using the cache")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    subparser = subparsers.add_parser("gc", description="remove least recently used libraries to meet a disk budget")
+    subparser.add_argument("--max-disk", dest="max_disk", type=parse_size, required=True,
+                           help="disk budget of the images and containers of docker (such as 200G)")
+    subparser.add_argument("--dry_run", action="store_true", help="only report what would be removed")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    subparser = subparsers.add_parser("daemon", description="serve the actions of clients from a long-lived process")
+    subparser.add_argument("--verbose", action="store_true", help="make logger be more verbose")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_argument_parser().parse_args()
+    if args.action != "daemon" and not args.direct:
+        status = run_client(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+    main(args)
@@ -0,0 +1,97 @@
+"""Thin client of the curator daemon (``curator.py daemon``).
+
+It takes the same arguments as ``curator.py`` and only imports the standard library, so an action served by a running
+daemon does not pay for the imports and the docker probing of ``curator.py``. Without a daemon, the action is run by
+``curator.py`` directly.
+"""
+
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+
+# Directory of the daemon serving this user, which only the user can access, and the unix socket in it. Both are kept
+# out of the (possibly shared) cache directory.
+DAEMON_DIRECTORY = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", f"curatord-{os.getuid()}")
+DAEMON_SOCKET = os.path.join(DAEMON_DIRECTORY, "curatord.sock")
+
+
+def is_private(path):
+    """Checks whether a path is owned by this user and cannot be accessed by the others."""
+    try:
+        status = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return status.st_uid == os.getuid() and not stat.S_ISLNK(status.st_mode) and status.st_mode & 0o077 == 0
+
+
+def make_private_directory(path):
+    """Makes a directory which only this user can access, and refuses an existing one which the others can."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not is_private(path) or not os.path.isdir(path):
+        raise RuntimeError(f"Directory {path} is not owned by the user or can be accessed by the others")
+
+
+def get_peer_uid(connection):
+    """Returns the user of the process on the other end of a unix socket, or None if the platform cannot tell."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
+
+
+def run_client(argv, socket_path=DAEMON_SOCKET):
+    """Runs an action on the daemon with the standard streams of this process.
+
+    The streams are passed over the socket, so the action prints to and prompts on the terminal of the client, and
+    interrupts are relayed to the action. Returns the exit status of the action, or None if no daemon serves it.
+    The environment and the streams are only passed to a daemon of this user, in a directory private to the user.
+    """
+    if not hasattr(socket, "send_fds") or not os.path.exists(socket_path):
+        return None
+    if not is_private(os.path.dirname(socket_path)) or os.stat(socket_path).st_uid != os.getuid():
+        sys.stderr.write(f"Refuse to use the daemon at {socket_path}, which is not private to the user\n")
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+
+    with connection:
+        peer_uid = get_peer_uid(connection)
+        if peer_uid is not None and peer_uid != os.getuid():
+            sys.stderr.write(f"Refuse to use the daemon at {socket_path}, which is run by user {peer_uid}\n")
+            return None
+        request = json.dumps({"argv": list(argv), "cwd": os.getcwd(), "environ": dict(os.environ)}).encode('utf-8')
+        request += b"\n"
+        sent = socket.send_fds(connection, [request], [0, 1, 2])
+        connection.sendall(request[sent:])
+
+        # The daemon answers with the pid of the process serving the action, and then with its exit status
+        reader = connection.makefile("rb")
+        messages = []
+        while len(messages) < 2:
+            try:
+                line = reader.readline()
+            except KeyboardInterrupt:
+                connection.sendall(json.dumps({"signal": int(signal.SIGINT)}).encode('utf-8') + b"\n")
+                continue
+            if not line:
+                break
+            messages.append(json.loads(line))
+    if not messages:
+        return None
+    return messages[-1].get("status", 1)
+
+
+if __name__ == "__main__":
+    status = run_client(sys.argv[1:]) if sys.argv[1:2] != ["daemon"] else None
+    if status is None:
+        curator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curator.py")
+        os.execv(sys.executable, [sys.executable, curator, "--direct"] + sys.argv[1:])
+    sys.exit(status)
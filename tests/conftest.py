@@ -0,0 +1,48 @@
+"""Fixtures of the tests, which run curator in-process against the stand-in docker of ``benchmarks/fake_docker.py``."""
+
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path[:0] = [ROOT, os.path.join(ROOT, "third_party", "pytools"), os.path.join(ROOT, "benchmarks")]
+
+import curator  # noqa: E402
+import fake_docker  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    # Hashes, manifests, plans and usage records are kept apart for every test
+    path = tmp_path / "cache"
+    monkeypatch.setattr(curator, "CACHE_DIRECTORY", str(path))
+    return path
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("curator.tests")
+
+
+@pytest.fixture
+def fake_host(tmp_path, monkeypatch):
+    """Returns the directory of a simulated host with the images ``fake/image0`` to ``fake/image2``, which is served by
+    the stand-in docker both as an executable and in-process."""
+    path = tmp_path / "host"
+    fake_docker.make_host(str(path), images=3)
+    monkeypatch.setenv("FAKE_DOCKER_HOME", str(path))
+    monkeypatch.setattr(fake_docker, "HOME", str(path))
+    return path
+
+
+@pytest.fixture
+def docker(fake_host, logger):
+    return curator.DockerCLI(fake_docker.__file__, logger)
+
+
+def write_file(path, content=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as writer:
+        writer.write(content)
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import curator
+from conftest import write_file
+
+
+@pytest.mark.parametrize("pattern, path, is_matched", [
+    ("*.log", "a.log", True),
+    ("*.log", "logs/a.log", False),
+    ("**/*.log", "a.log", True),
+    ("**/*.log", "logs/old/a.log", True),
+    ("logs/**", "logs/old/a.log", True),
+    ("build", "build", True),
+    ("build", "build/out/a.o", True),
+    ("build", "builder", False),
+    ("file?.txt", "file1.txt", True),
+    ("file?.txt", "file10.txt", False),
+    ("file?.txt", "file/.txt", False),
+    ("[ab].txt", "b.txt", True),
+    ("[ab].txt", "c.txt", False),
+    ("a\\*b", "a*b", True),
+    ("a\\*b", "axb", False),
+    ("a.b", "axb", False),
+])
+def test_dockerignore_pattern(pattern, path, is_matched):
+    assert bool(curator._compile_dockerignore_pattern(pattern).fullmatch(path)) == is_matched
+
+
+def test_context_files_follow_dockerignore(tmp_path):
+    for name in ("Dockerfile", "main.py", "debug.log", "keep.log", "logs/a.log", "build/out.o", "secret", "src/secret"):
+        write_file(str(tmp_path / name))
+    write_file(str(tmp_path / ".dockerignore"), "# comment\n\n*.log\n!keep.log\nbuild/\n/secret\n")
+    assert curator.get_context_files(str(tmp_path)) == [
+        ".dockerignore", "Dockerfile", "keep.log", "logs/a.log", "main.py", "src/secret"]
+
+
+def test_context_files_keep_dockerfile_and_dockerignore(tmp_path):
+    write_file(str(tmp_path / "Dockerfile"))
+    write_file(str(tmp_path / "main.py"))
+    write_file(str(tmp_path / ".dockerignore"), "*\n")
+    assert curator.get_context_files(str(tmp_path)) == [".dockerignore", "Dockerfile"]
+
+
+def test_context_files_reinclude_files_of_excluded_directories(tmp_path):
+    for name in ("Dockerfile", "build/out.o", "build/keep/a.txt"):
+        write_file(str(tmp_path / name))
+    write_file(str(tmp_path / ".dockerignore"), "build\n!build/keep\n")
+    assert curator.get_context_files(str(tmp_path)) == [".dockerignore", "Dockerfile", "build/keep/a.txt"]
+
+
+def test_context_files_list_symlinks_without_following_them(tmp_path):
+    write_file(str(tmp_path / "Dockerfile"))
+    write_file(str(tmp_path / "data" / "a.txt"))
+    os.symlink("data", str(tmp_path / "linked_data"))
+    os.symlink("data/a.txt", str(tmp_path / "linked_file"))
+    assert curator.get_context_files(str(tmp_path)) == ["Dockerfile", "data/a.txt", "linked_data", "linked_file"]
+
+
+def test_context_files_leave_out_ignored_symlinks(tmp_path):
+    write_file(str(tmp_path / "Dockerfile"))
+    os.makedirs(str(tmp_path / "data"))
+    os.symlink("data", str(tmp_path / "linked_data"))
+    write_file(str(tmp_path / ".dockerignore"), "linked_*\n")
+    assert curator.get_context_files(str(tmp_path)) == [".dockerignore", "Dockerfile"]
+
+
+@pytest.mark.parametrize("dockerfile, bases", [
+    ("FROM ubuntu:22.04\nRUN true\n", ["ubuntu:22.04"]),
+    ("from ubuntu:22.04 as Builder\nFROM builder\nFROM python:3.11\n", ["ubuntu:22.04", "python:3.11"]),
+    ("ARG BASE=ubuntu\nARG TAG=\"22.04\"\nFROM $BASE:${TAG}\n", ["ubuntu:22.04"]),
+    # Arguments declared after the first FROM only apply to their stage
+    ("ARG BASE=ubuntu\nFROM $BASE\nARG BASE=python\nFROM $BASE\n", ["ubuntu", "ubuntu"]),
+    ("FROM --platform=linux/amd64 \\\n    nvidia/cuda:12.2.0-base AS cuda\nFROM scratch\n",
+     ["nvidia/cuda:12.2.0-base"]),
+])
+def test_library_bases(tmp_path, dockerfile, bases):
+    write_file(str(tmp_path / "Dockerfile"), dockerfile)
+    assert curator.get_library_bases(str(tmp_path)) == bases
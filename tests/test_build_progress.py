@@ -0,0 +1,47 @@
+import curator
+
+
+def feed(progress, lines):
+    for line in lines:
+        progress.feed(line)
+    progress.close()
+    return [(step.index, step.total, step.instruction, step.is_cached) for step in progress.steps]
+
+
+def test_classic_builder_steps(logger):
+    progress = curator.BuildProgress(logger)
+    assert feed(progress, [
+        "Sending build context to Docker daemon  2.048kB",
+        "Step 1/3 : FROM ubuntu:22.04",
+        " ---> 3b418d7b466a",
+        "Step 2/3 : RUN apt-get update",
+        " ---> Using cache",
+        " ---> 5e4c2a0c6c1b",
+        "Step 3/3 : USER user",
+        " ---> Running in 0123456789ab",
+        "Removing intermediate container 0123456789ab",
+        "Successfully built 6f1e2d3c4b5a",
+    ]) == [(1, 3, "FROM ubuntu:22.04", False), (2, 3, "RUN apt-get update", True), (3, 3, "USER user", False)]
+
+
+def test_buildkit_steps(logger):
+    progress = curator.BuildProgress(logger)
+    assert feed(progress, [
+        "#1 [internal] load build definition from Dockerfile",
+        "#1 DONE 0.0s",
+        "#5 [1/3] FROM docker.io/library/ubuntu:22.04",
+        "#5 CACHED",
+        "#6 [2/3] RUN apt-get update",
+        "#7 [stage-1 3/3] COPY . /app",
+        "#6 0.512 Get:1 http://archive.ubuntu.com/ubuntu jammy InRelease",
+        "#6 [2/3] RUN apt-get update",
+        "#6 DONE 1.5s",
+        "#7 DONE 0.2s",
+    ]) == [(1, 3, "FROM docker.io/library/ubuntu:22.04", True), (2, 3, "RUN apt-get update", False),
+           (3, 3, "COPY . /app", False)]
+    assert [step.elapsed for step in progress.steps] == [0.0, 1.5, 0.2]
+
+
+def test_output_without_steps(logger):
+    progress = curator.BuildProgress(logger)
+    assert feed(progress, ["Sending build context to Docker daemon  2.048kB", "#1 DONE 0.0s", ""]) == []
@@ -0,0 +1,85 @@
+import json
+import os
+import socket
+import types
+
+import pytest
+
+import curator
+import fake_docker
+
+
+def record_usage(reference, last_used, runtime=None, bases=()):
+    record = {"library": reference, "host": socket.gethostname(), "path": f"/libraries/{reference}",
+              "runtime": runtime or reference.split(':')[0].replace('/', '_'), "bases": list(bases),
+              "built": last_used - 10.0, "started": last_used}
+    with open(curator.get_library_usage_path(reference), "w") as writer:
+        json.dump(record, writer)
+
+
+def add_container(name, image, status="Up 2 hours"):
+    with fake_docker.lock_state() as state:
+        state["containers"][name] = {"image": image, "status": status,
+                                     "labels": {curator.RUN_FINGERPRINT_LABEL: "0"}, "size": 1000}
+        fake_docker.write_state(state)
+
+
+def get_host_state():
+    with fake_docker.lock_state() as state:
+        return sorted(state["images"]), sorted(state["containers"])
+
+
+def collect_garbage(docker, use_dry_run=False, is_over_budget=True):
+    # Just over the budget, the least recently used library that can be removed is enough
+    usage = docker.get_disk_usage()
+    docker.collect_garbage(types.SimpleNamespace(max_disk=usage - 1 if is_over_budget else usage, dry_run=use_dry_run))
+
+
+@pytest.fixture
+def images():
+    return ["fake/image0:latest", "fake/image1:latest", "fake/image2:latest"]
+
+
+def test_least_recently_used_library_is_removed(docker, images):
+    record_usage("fake/image1:latest", 100.0)
+    record_usage("fake/image2:latest", 200.0)
+    collect_garbage(docker)
+    # Images which curator has not recorded are never removed
+    assert get_host_state() == ([images[0], images[2]], [])
+    assert not os.path.exists(curator.get_library_usage_path("fake/image1:latest"))
+    assert os.path.exists(curator.get_library_usage_path("fake/image2:latest"))
+
+
+def test_base_of_kept_library_is_kept(docker, images):
+    record_usage("fake/image0:latest", 100.0)
+    record_usage("fake/image1:latest", 300.0, bases=["fake/image0"])
+    record_usage("fake/image2:latest", 200.0)
+    collect_garbage(docker)
+    assert get_host_state() == ([images[0], images[1]], [])
+
+
+def test_library_used_by_running_or_other_containers_is_kept(docker, images):
+    record_usage("fake/image0:latest", 100.0)
+    record_usage("fake/image1:latest", 200.0)
+    record_usage("fake/image2:latest", 300.0)
+    add_container("fake_image0", "fake/image0")
+    add_container("other", "fake/image1", status="Exited (0) 2 hours ago")
+    collect_garbage(docker)
+    assert get_host_state() == ([images[0], images[1]], ["fake_image0", "other"])
+
+
+def test_stopped_runtime_is_removed_with_its_library(docker, images):
+    record_usage("fake/image0:latest", 100.0)
+    record_usage("fake/image1:latest", 200.0)
+    add_container("fake_image0", "fake/image0", status="Exited (0) 2 hours ago")
+    collect_garbage(docker)
+    assert get_host_state() == ([images[1], images[2]], [])
+
+
+def test_nothing_is_removed_within_budget_or_on_dry_run(docker, images):
+    record_usage("fake/image0:latest", 100.0)
+    add_container("fake_image0", "fake/image0", status="Exited (0) 2 hours ago")
+    collect_garbage(docker, is_over_budget=False)
+    collect_garbage(docker, use_dry_run=True)
+    assert get_host_state() == (images, ["fake_image0"])
+    assert os.path.exists(curator.get_library_usage_path("fake/image0:latest"))
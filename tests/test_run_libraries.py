@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+
+import pytest
+
+import curator
+from conftest import write_file
+
+
+class RecordingDocker(object):
+    """Stands in for the backend of every library, and records the libraries its actions run on."""
+
+    def __init__(self, failures=()):
+        self._lock = threading.Lock()
+        self._failures = set(failures)
+        self.calls = []
+
+    def _run(self, action, config):
+        with self._lock:
+            self.calls.append((action, config.library.name))
+        if config.library.name in self._failures:
+            raise RuntimeError(f"Unable to {action} {config.library.name}")
+
+    def build(self, config):
+        self._run("build", config)
+
+    def clean(self, config):
+        self._run("clean", config)
+
+
+@pytest.fixture
+def libraries(tmp_path, monkeypatch):
+    """Writes libraries, given by their names and ``FROM`` bases, and returns their paths by names."""
+    monkeypatch.chdir(tmp_path)
+
+    def write_libraries(bases):
+        paths = dict()
+        for name, base in bases.items():
+            paths[name] = str(tmp_path / name)
+            write_file(os.path.join(paths[name], "Dockerfile"), f"FROM {base}\n")
+            write_file(os.path.join(paths[name], "config.json"),
+                       json.dumps({"library": {"name": f"test/{name}"}, "runtime": {"name": f"test_{name}"}}))
+        return paths
+    return write_libraries
+
+
+def run_libraries(action, paths, docker, monkeypatch, logger):
+    monkeypatch.setattr(curator, "get_docker", lambda config, logger: docker)
+    args = curator.get_argument_parser().parse_args([action, *paths, "--jobs", "2"])
+    curator.run_libraries(args, logger)
+
+
+def test_libraries_run_after_their_bases(libraries, monkeypatch, logger):
+    paths = libraries({"a": "ubuntu", "b": "test/a", "c": "test/b:latest", "d": "ubuntu"})
+    docker = RecordingDocker()
+    run_libraries("build", [paths["c"], paths["b"], paths["a"], paths["d"]], docker, monkeypatch, logger)
+    names = [name for _, name in docker.calls]
+    assert sorted(names) == ["test/a", "test/b", "test/c", "test/d"]
+    assert names.index("test/a") < names.index("test/b") < names.index("test/c")
+
+
+def test_clean_runs_before_the_bases(libraries, monkeypatch, logger):
+    paths = libraries({"a": "ubuntu", "b": "test/a", "c": "test/b"})
+    docker = RecordingDocker()
+    run_libraries("clean", [paths["a"], paths["b"], paths["c"]], docker, monkeypatch, logger)
+    assert docker.calls == [("clean", "test/c"), ("clean", "test/b"), ("clean", "test/a")]
+
+
+def test_failed_library_skips_its_dependents(libraries, monkeypatch, logger):
+    paths = libraries({"a": "ubuntu", "b": "test/a", "c": "test/b", "d": "ubuntu"})
+    docker = RecordingDocker(failures=["test/a"])
+    with pytest.raises(RuntimeError) as error:
+        run_libraries("build", list(paths.values()), docker, monkeypatch, logger)
+    assert sorted(name for _, name in docker.calls) == ["test/a", "test/d"]
+    assert str(error.value) == f"Unable to build libraries: {paths['a']}, {paths['b']}, {paths['c']}"
+
+
+def test_cyclic_libraries_are_refused(libraries, monkeypatch, logger):
+    paths = libraries({"a": "test/b", "b": "test/a", "c": "ubuntu"})
+    docker = RecordingDocker()
+    with pytest.raises(ValueError, match="cyclic FROM dependencies"):
+        run_libraries("build", list(paths.values()), docker, monkeypatch, logger)
+    assert docker.calls == [("build", "test/c")]
+
+
+def test_library_built_from_itself_is_not_a_cycle(libraries, monkeypatch, logger):
+    paths = libraries({"a": "test/a", "b": "ubuntu"})
+    docker = RecordingDocker()
+    run_libraries("build", list(paths.values()), docker, monkeypatch, logger)
+    assert sorted(name for _, name in docker.calls) == ["test/a", "test/b"]